@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+ Benchmark of the `scontrol show node -o` parser
+
+ Synthetic output, one line per node as scontrol prints it, is parsed with
+ slurm_utils.parse_node_resources() and the best time of --repeat runs is
+ reported for each node count.
+
+ Usage:
+   python3 bench/bench_node_resources.py --nodes 100 1000 5000
+"""
+
+import sys
+import time
+import argparse
+
+sys.path.append(".")
+import ecc.slurm_utils as slurm_utils
+
+
+NODE_LINE = ("NodeName=ecc{nr}.usegalaxy.no Arch=x86_64 CoresPerSocket=1 CPUAlloc={alloc} CPUEfctv=16 CPUTot=16 "
+             "CPULoad={load:.2f} AvailableFeatures=(null) ActiveFeatures=(null) Gres=(null) NodeAddr=ecc{nr}.usegalaxy.no "
+             "NodeHostName=ecc{nr}.usegalaxy.no Version=22.05.8 OS=Linux 5.14.0-162.6.1.el9_1.x86_64 #1 SMP "
+             "RealMemory=64000 AllocMem={memory} FreeMem=48000 Sockets=16 Boards=1 State={state} ThreadsPerCore=1 "
+             "TmpDisk=0 Weight=1 Owner=N/A MCS_label=N/A Partitions=usegalaxy_production "
+             "BootTime=2023-01-01T00:00:00 SlurmdStartTime=2023-01-01T00:00:10 LastBusyTime=2023-01-01T12:00:00 "
+             "CfgTRES=cpu=16,mem=62.50G,billing=16 AllocTRES=cpu={alloc},mem={memory}M CapWatts=n/a "
+             "CurrentWatts=0 AveWatts=0 ExtSensorsJoules=n/s ExtSensorsWatts=0 ExtSensorsTemp=n/s")
+
+
+def scontrol_output(count:int) -> bytes:
+    """ `scontrol show node -o` output for count nodes """
+
+    states = ['IDLE', 'MIXED', 'ALLOCATED']
+    lines = []
+    for nr in range(0, count):
+        alloc = (nr * 5) % 17
+        lines.append(NODE_LINE.format(nr=nr, alloc=alloc, load=alloc * 0.9, memory=alloc * 4000, state=states[nr % 3]))
+
+    return ("\n".join(lines) + "\n").encode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the scontrol show node -o parser')
+    parser.add_argument('-n', '--nodes', type=int, nargs='+', default=[100, 1000, 5000], help="number of nodes")
+    parser.add_argument('-r', '--repeat', type=int, default=5, help="runs per node count, the best is reported")
+    args = parser.parse_args()
+
+    print("{:>8} {:>10} {:>10} {:>12}".format('nodes', 'bytes', 'parse(ms)', 'per node(us)'))
+    for count in args.nodes:
+        output = scontrol_output(count)
+
+        best = None
+        for _ in range(0, args.repeat):
+            start = time.perf_counter()
+            table = slurm_utils.parse_node_resources(output)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        if len(table) != count:
+            sys.exit("parsed {} nodes, expected {}".format(len(table), count))
+
+        print("{:>8} {:>10} {:>10.2f} {:>12.1f}".format(count, len(output), best * 1000, best * 1e6 / count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+ Benchmark of Openstack.servers() against a fake Nova
+
+ Every fake api call takes --latency seconds, the listing is paginated like
+ nova (--page servers per page). The detailed listing is compared to the
+ old way of looking up every server with a get_server call.
+
+ Usage:
+   python3 bench/bench_servers.py --servers 50 200 1000 --latency 0.005
+"""
+
+import sys
+import time
+import argparse
+
+sys.path.append(".")
+import ecc.openstack_class as openstack_class
+
+
+class FakeServer(object):
+
+    def __init__(self, nr:int):
+        self.id = "vm-{:06d}".format(nr)
+        self.name = "ecc{}.usegalaxy.no".format(nr)
+        self.status = 'ACTIVE'
+        self.addresses = {'dualStack': [{'version': 4, 'addr': "10.0.{}.{}".format(nr // 250, nr % 250 + 1)},
+                                        {'version': 6, 'addr': "2001:700::{:x}".format(nr)}]}
+
+
+class FakeCompute(object):
+
+    def __init__(self, count:int, latency:float, page:int):
+        self.servers_list = [FakeServer(nr) for nr in range(0, count)]
+        self.latency = latency
+        self.page = page
+        self.calls = 0
+
+    def _call(self):
+        self.calls += 1
+        time.sleep(self.latency)
+
+    def servers(self, details:bool=True):
+        for start in range(0, max(1, len(self.servers_list)), self.page):
+            self._call()
+            for server in self.servers_list[start:start + self.page]:
+                yield server
+
+    def get_server(self, id:str):
+        self._call()
+        for server in self.servers_list:
+            if server.id == id:
+                return server
+
+
+class FakeConnection(object):
+
+    def __init__(self, count:int, latency:float, page:int):
+        self.compute = FakeCompute(count, latency, page)
+
+
+def per_server(openstack) -> []:
+    """ the listing as it was done before, a get_server call per server """
+
+    servers = []
+    for server in openstack._connection.compute.servers(details=False):
+        server = openstack._connection.compute.get_server(server.id)
+        servers.append({'id': server.id, 'name': server.name.lower(),
+                        'ip': openstack._addresses(server, ipv=4), 'status': server.status.lower()})
+    return servers
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the server listing against a fake nova')
+    parser.add_argument('-s', '--servers', type=int, nargs='+', default=[50, 200, 1000], help="number of servers")
+    parser.add_argument('-l', '--latency', type=float, default=0.005, help="seconds per api call")
+    parser.add_argument('-p', '--page', type=int, default=1000, help="servers per listing page")
+    args = parser.parse_args()
+
+    print("{:>8} {:>12} {:>8} {:>14} {:>8}".format('servers', 'detailed(s)', 'calls', 'per-server(s)', 'calls'))
+    for count in args.servers:
+        openstack = openstack_class.Openstack()
+        openstack._connection = FakeConnection(count, args.latency, args.page)
+
+        start = time.time()
+        openstack.servers(cache=False)
+        detailed, detailed_calls = time.time() - start, openstack._connection.compute.calls
+
+        openstack._connection.compute.calls = 0
+        start = time.time()
+        per_server(openstack)
+        old, old_calls = time.time() - start, openstack._connection.compute.calls
+
+        print("{:>8} {:>12.3f} {:>8} {:>14.3f} {:>8}".format(count, detailed, detailed_calls, old, old_calls))
+
+
+if __name__ == '__main__':
+    main()
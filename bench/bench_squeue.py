@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+ Benchmark of the streaming squeue parser
+
+ Synthetic squeue lines (see slurm_utils.SQUEUE_FIELDS) are fed to:
+   buffered:  the whole stdout as one bytes object, parsed into a dict per job, as before
+   stream:    slurm_utils.aggregate_jobs() counting the jobs only
+   snapshot:  slurm_utils.aggregate_jobs() keeping the pending jobs, as the snapshot does
+
+ For each the parse time and the peak memory (tracemalloc) are reported.
+ The streamed lines are generated one at the time, like they are read from
+ the squeue pipe, so they do not add to the peak. The times include making
+ the lines. A quarter of the jobs are array tasks, 50 per array, so the
+ stream peak still grows with the running arrays it counts tasks for.
+
+ Usage:
+   python3 bench/bench_squeue.py --lines 10000 100000 1000000
+"""
+
+import sys
+import time
+import argparse
+import tracemalloc
+
+sys.path.append(".")
+import ecc.slurm_utils as slurm_utils
+
+
+STATES = ['PD', 'PD', 'R', 'PD', 'R', 'CG']
+
+
+def squeue_line(nr:int) -> bytes:
+    state = STATES[nr % len(STATES)]
+    job_id = "{}_{}".format(100000 + nr // 50, nr % 50) if nr % 4 == 0 else str(1000000 + nr)
+    reason = '(Resources)' if state == 'PD' else 'ecc{}.usegalaxy.no'.format(nr % 200)
+    return "{}|usegalaxy_production|galaxy|{}|0:00|1|{}|{}G|1-00:00:00|{}|g{}_bowtie2_user{}\n".format(
+        job_id, state, 1 + nr % 8, 1 + nr % 32, reason, nr, nr % 300).encode('utf-8')
+
+
+def squeue_lines(count:int):
+    for nr in range(0, count):
+        yield squeue_line(nr)
+
+
+def buffered(count:int) -> dict:
+    """ the parsing as it was done before the streaming parser """
+
+    stdout = b"".join(squeue_lines(count))
+    jobs = slurm_utils._parse(stdout, slurm_utils.SQUEUE_FIELDS)
+    return {'jobs': jobs, 'jobs_by_state': slurm_utils._count(jobs, 'state')}
+
+
+def stream(count:int) -> dict:
+    return slurm_utils.aggregate_jobs(squeue_lines(count))
+
+
+def snapshot(count:int) -> dict:
+    return slurm_utils.aggregate_jobs(squeue_lines(count), keep_states=slurm_utils.PENDING_STATES)
+
+
+def measure(func, count:int) -> (float, int):
+    """ run time (s) without and peak memory (bytes) with tracemalloc, as it slows things down """
+
+    start = time.perf_counter()
+    result = func(count)
+    elapsed = time.perf_counter() - start
+    del result
+
+    tracemalloc.start()
+    result = func(count)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the streaming squeue parser')
+    parser.add_argument('-l', '--lines', type=int, nargs='+', default=[10000, 100000, 1000000], help="number of squeue lines")
+    parser.add_argument('-m', '--methods', nargs='+', default=['buffered', 'stream', 'snapshot'],
+                        choices=['buffered', 'stream', 'snapshot'], help="parsers to run")
+    args = parser.parse_args()
+
+    funcs = {'buffered': buffered, 'stream': stream, 'snapshot': snapshot}
+
+    print("{:>9} {:>10} {:>10} {:>12}".format('lines', 'parser', 'time(s)', 'peak(MB)'))
+    for count in args.lines:
+        for method in args.methods:
+            elapsed, peak = measure(funcs[ method ], count)
+            print("{:>9} {:>10} {:>10.3f} {:>12.2f}".format(count, method, elapsed, peak / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -34,6 +34,7 @@ import kbr.log_utils as logger
 
 import ecc
 import ecc.utils
+import ecc.inventory_utils as inventory_utils
 
 
 
@@ -42,46 +43,6 @@ import ecc.utils
 
 
 
-def readin_inventory(ansible_dir:str) -> {}:
-
-    inventory = f"{ansible_dir}/hosts   "
-
-    if os.path.isfile(f"{ansible_dir}/ansible.cfg"):
-        config = configparser.ConfigParser()
-        config.read(f"{ansible_dir}/ansible.cfg")
-        if 'defaults' in config and 'inventory' in config['defaults']:
-            inventory = f"{ansible_dir}/{config['defaults']['inventory']}"
-
-
-
-    try:
-        config = configparser.ConfigParser()
-        config.read(inventory)
-    except:
-        print('could not find or open the inventory file')
-        sys.exit(-1)
-
-
-    hosts = {f"slurm":{"hosts":[]}, "_meta": {"hostvars":{}}}
-
-
-    for section in config.sections():
-        hosts[section] = {}
-        hosts[section]["hosts"] = []
-        for key in config[section].keys():
-            line = f"{key}={''.join(config[section][key])}"
-
-            fields = line.split()
-            host = fields[ 0 ]
-            hosts[section]["hosts"].append( host )
-            hosts["_meta"]['hostvars'][host] = {}
-            for f in fields[1:]:
-                key, value = f.split("=")
-                hosts["_meta"]['hostvars'][host][key] = value
-
-
-    return hosts
-
 def main():
 
     parser = argparse.ArgumentParser(description='ehos_status: print ehos status in telegraf format')
@@ -103,11 +64,18 @@ def main():
     logger.init(name='ecc_nodes', log_file=None)
     logger.set_log_level(0)
 
-    hosts = readin_inventory(config.ecc.ansible_dir)
+    cache_file = inventory_utils.cache_file(config.ecc)
+    cache = inventory_utils.read_cache(cache_file, config.ecc.ansible_dir, ttl=int(config.ecc.get('inventory_cache_ttl', 120)))
+
+    if cache is not None:
+        hosts = cache['inventory']
+        nodes = cache['nodes']
+    else:
+        hosts = inventory_utils.readin_inventory(config.ecc.ansible_dir)
 
-    config.ecc.name_regex = config.ecc.name_template.format("([01-99])")
-    ecc.openstack_connect(config.openstack)
-    nodes = ecc.servers(config.ecc.name_regex)
+        ecc.openstack_connect(config.openstack)
+        nodes = ecc.servers(ecc.names_regex(ecc.pool_configs(config.ecc)))
+        inventory_utils.write_cache(cache_file, config.ecc.ansible_dir, nodes)
 
 
     # get the current nodes
@@ -21,6 +21,8 @@ import ecc
 import ecc.slurm_utils as slurm_utils
 import ecc.cloudflare_utils as cloudflare_utils
 import ecc.ansible_utils as ansible_utils
+import ecc.forecast_utils as forecast_utils
+import ecc.phone_home_utils as phone_home_utils
 
 
 version = version_utils.as_string('ecc')
@@ -35,10 +37,18 @@ def init(args):
         logger.init(name=program_name, log_file=config.ecc.get('logfile', None))
         logger.set_log_level(args.verbose)
         logger.info(f'{program_name} (v:{version})')
-        config.ecc.name_regex = config.ecc.name_template.format("(\d+)")
         ecc.set_config(config)
         ecc.openstack_connect(config.openstack)
         cloudflare_utils.init(config.ecc.cloudflare_apikey, config.ecc.cloudflare_email)
+        ecc.load_nodes()
+        # nodes report in here when they are up, instead of us polling their console logs
+        if config.ecc.get('phone_home_port', None):
+            # only on the address the nodes reach the controller on, not on every interface
+            bind = config.ecc.get('phone_home_bind', None) or config.ecc.get('controller_ip', None)
+            if bind is None:
+                logger.warning("phone_home_port is set, but neither phone_home_bind nor controller_ip, not listening for nodes")
+            else:
+                phone_home_utils.start(int(config.ecc.phone_home_port), bind)
     else:
         logger.init(name=program_name)
         logger.set_log_level(args.verbose)
@@ -46,47 +56,116 @@ def init(args):
 
 
 
-def run_daemon() -> None:
-    """ Creates the ecc daemon loop that creates and destroys nodes etc.
-    """
+def request_nodes(count:int, pool:str=None) -> None:
+    """ requests nodes in a pool, an openstack error only costs this pool its nodes for this tick """
 
-    while (True):
+    try:
+        ecc.request_nodes(count=count, pool=pool)
+    except Exception as e:
+        logger.warning(f"Could not request {count} nodes in pool {pool}")
+        logger.debug("Error: {}".format(e))
 
-        # get the current number of nodes and jobs
-        ecc.update_nodes_status()
 
-        nodes_total = ecc.nodes_total()
-        nodes_idle = ecc.nodes_idle()
-        jobs_pending = slurm_utils.jobs_pending()
+def scale_nodes() -> None:
+    """ works out the nodes to request or drain this tick """
 
-        print(f"nodes_total: {nodes_total}, nodes_idle: {nodes_idle}, jobs_pending: {jobs_pending}")
+    # get the current number of nodes and jobs, one squeue and sinfo call shared by everything below
+    slurm_utils.snapshot(refresh=True)
+    ecc.update_nodes_status()
 
-        # Below the min number of nodes needed for our setup
-        if nodes_total < config.ecc.nodes_min:
-            logger.info("We are below the min number of nodes, creating {} nodes".format(
-                config.ecc.nodes_min - nodes_total))
+    nodes_total = ecc.nodes_total()
+    nodes_idle = ecc.nodes_idle()
+    nodes_in_flight = ecc.nodes_in_flight()
+    # only jobs waiting for resources can be helped by more nodes
+    jobs_pending = slurm_utils.jobs_pending(ecc.scale_reasons())
 
-            ecc.create_nodes(cloud_init_file=config.ecc.cloud_init, count=config.ecc.nodes_min - nodes_total)
+    print(f"nodes_total: {nodes_total}, nodes_idle: {nodes_idle}, nodes_in_flight: {nodes_in_flight}, jobs_pending: {jobs_pending}")
 
-        ### there are jobs queuing, let see what we should do
+    forecast_utils.record(jobs_pending, slurm_utils.jobs_running(), nodes_total, nodes_idle)
+    forecast_utils.record_arrivals(slurm_utils.snapshot()['last_job_id'])
+    nodes_prewarm = ecc.prewarm_nodes()
 
-        # Got room to make some additional nodes
-        elif (jobs_pending and nodes_idle == 0 and nodes_total <= int(config.ecc.nodes_max)):
+    nodes_missing = {}
+    for pool in ecc.node_pools.values():
+        total = ecc.nodes_total(pool=pool.pool)
+        in_flight = ecc.nodes_in_flight(pool=pool.pool)
+        # nodes_min, and the spare idle nodes so the next jobs do not wait for a boot
+        missing = max(int(pool.nodes_min) - total, ecc.spare_nodes(pool.pool) - ecc.nodes_ready(pool=pool.pool)) - in_flight
+        missing = min(missing, int(pool.nodes_max) - total - in_flight)
+        if missing > 0:
+            nodes_missing[ pool.pool ] = missing
 
-            logger.info("We got stuff to do, creating some additional nodes...")
+    ### there are jobs queuing, let see what we should do
 
-            ecc.create_nodes(cloud_init_file=config.ecc.cloud_init, count=1)
+    # Got room to make some additional nodes, the plan leaves out the jobs the free nodes can take
+    plan = {}
+    if jobs_pending and nodes_in_flight == 0:
 
-        # We got extra nodes not needed and we can delete some without going under the min cutoff, so lets get rid of some
-        elif jobs_pending == 0 and nodes_idle and nodes_total > config.ecc.nodes_min:
+        # a new node only helps if the jobs are not done before it is up
+        if not ecc.backlog_outlasts_boot():
+            logger.info("The pending jobs are done before a new node would be up, not creating any.")
+        else:
+            plan = ecc.scale_out_plan()
+            if not plan:
+                logger.info("Pending jobs fit the free nodes, do not fit a new node, or we are out of room/quota.")
+
+    # the spare nodes are there for the jobs to come, so the larger of the two is created, not both
+    nodes_wanted = {}
+    for pool in set(nodes_missing.keys()) | set(plan.keys()):
+        nodes_wanted[ pool ] = max(nodes_missing.get(pool, 0), plan.get(pool, 0))
+
+    if nodes_wanted:
+        for pool, nr_of_nodes_to_create in nodes_wanted.items():
+            if plan.get(pool, 0) >= nodes_missing.get(pool, 0):
+                logger.info(f"We got stuff to do, creating {nr_of_nodes_to_create} additional nodes in pool {pool}...")
+            else:
+                logger.info(f"We are below the min or spare number of nodes in pool {pool}, creating {nr_of_nodes_to_create} nodes")
+            request_nodes(nr_of_nodes_to_create, pool)
+
+    # More jobs are expected than the nodes we have can take, boot them before the jobs arrive
+    elif nodes_prewarm and nodes_in_flight == 0:
+        logger.info(f"Expecting more jobs, pre-warming {nodes_prewarm} nodes...")
+        request_nodes(nodes_prewarm)
+
+    # We got extra nodes not needed and we can delete some without going under the min cutoff, so lets get rid of some
+    elif jobs_pending == 0 and nodes_idle:
+
+        for pool in ecc.node_pools.values():
+            # never below the floor, and never into the spare idle nodes
+            nr_of_nodes_to_delete = min(ecc.nodes_total(pool=pool.pool) - ecc.nodes_floor(pool.pool),
+                                        ecc.nodes_idle(pool=pool.pool),
+                                        ecc.nodes_ready(pool=pool.pool) - ecc.spare_nodes(pool.pool))
+            if nr_of_nodes_to_delete <= 0:
+                continue
+
+            logger.info(f"Deleting {nr_of_nodes_to_delete} idle nodes in pool {pool.pool}... ")
+            ecc.drain_idle_nodes(nr_of_nodes_to_delete, pool=pool.pool)
 
-            nr_of_nodes_to_delete = nodes_total - int(config.ecc.nodes_min)
+    else:
+        logger.info("Nothing to change.")
 
-            logger.info(f"Deleting {nr_of_nodes_to_delete} idle nodes... ")
-            ecc.delete_idle_nodes(nr_of_nodes_to_delete)
 
-        else:
-            logger.info("Nothing to change.")
+def run_daemon() -> None:
+    """ Creates the ecc daemon loop that creates and destroys nodes etc.
+
+    Nodes are requested or drained here, and moved along their lifecycle by
+    ecc.advance_nodes, so a tick never waits for a node to boot.
+    """
+
+    while (True):
+
+        # an openstack or slurm error skips the scaling of this tick, the nodes are still moved along
+        try:
+            scale_nodes()
+        except Exception as e:
+            logger.warning("Could not scale the nodes this tick")
+            logger.debug("Error: {}".format(e))
+
+        try:
+            ecc.advance_nodes()
+        except Exception as e:
+            logger.warning("Could not advance the nodes this tick")
+            logger.debug("Error: {}".format(e))
 
         logger.info("Napping for {} seccnd(s).".format(config.ecc.sleep))
         time.sleep(config.ecc.sleep)
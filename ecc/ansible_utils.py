@@ -1,8 +1,16 @@
 
+import os
 import json
+import time
+import shlex
 import pprint as pp
+from collections import deque
 
 import kbr.run_utils as run_utils
+import kbr.log_utils as logger
+
+# the most recent playbook runs: timestamp, duration (s), hosts (None for all) and exit status
+run_history = deque(maxlen=100)
 
 def file_path(filename:str=None) -> str:
     if filename is None:
@@ -15,12 +23,33 @@ def file_dir(filename:str=None) -> str:
     return os.path.dirname(file_path(filename))
 
 
-def run_playbook(cmd:str, cwd:str=None):
+def run_playbook(cmd:str, cwd:str=None, hosts:[]=None):
+    """ runs an ansible playbook command
+
+    Args:
+      cmd: ansible-playbook command line
+      cwd: directory to run the command in
+      hosts: only run against these hosts (--limit), default is the whole inventory
+
+    Returns:
+      the json playbook log, None if the playbook failed
+    """
+
+    if hosts is not None:
+        cmd = f"{cmd} --limit {shlex.quote(','.join(hosts))}"
 
     cmd = f"ANSIBLE_STDOUT_CALLBACK=ansible.posix.json ANSIBLE_HOST_KEY_CHECKING=False {cmd}"
 
 #    print(cwd, cmd)
+    start = time.time()
     r = run_utils.launch_cmd(cmd, cwd=cwd)
+    duration = time.time() - start
+
+    run_history.append({'timestamp': int(start),
+                        'duration': duration,
+                        'hosts': hosts,
+                        'status': r.p_status})
+    logger.info("playbook run on {} took {:.1f}s (exit {})".format( 'all hosts' if hosts is None else ','.join(hosts), duration, r.p_status))
 
     # the playbook failed!
     if r.p_status != 0:
@@ -30,3 +59,9 @@ def run_playbook(cmd:str, cwd:str=None):
     playbook_log = json.loads(r.stdout)
     return playbook_log
 
+
+def durations(limited:bool=None) -> []:
+    """ durations (s) of the recent playbook runs, optionally only the limited or the full runs """
+
+    return [run['duration'] for run in run_history
+            if limited is None or (run['hosts'] is not None) == limited]
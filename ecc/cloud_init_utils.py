@@ -0,0 +1,96 @@
+"""
+ Renders per node cloud-init user-data, so a node can configure itself and join slurm during boot
+
+ The pool cloud_init file is the template, the node name, the files
+ (eg slurm.conf and the munge key), /etc/hosts entries and commands are
+ added to its write_files and runcmd. File contents are gzip+base64
+ encoded, which keeps binary files intact and the user-data small.
+"""
+
+import io
+import gzip
+import base64
+
+import yaml
+
+
+def encode(content) -> str:
+    """ gzip+base64 encodes content (str or bytes) for a write_files entry """
+
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+
+    buffer = io.BytesIO()
+    # mtime=0 so the same content renders the same user-data
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as gz:
+        gz.write(content)
+
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def file_entry(path:str, content, owner:str='root:root', permissions:str='0644', append:bool=False) -> dict:
+    """ a write_files entry """
+
+    entry = {'path': path,
+             'content': encode(content),
+             'encoding': 'gz+b64',
+             'owner': owner,
+             'permissions': permissions}
+
+    if append:
+        entry['append'] = True
+
+    return entry
+
+
+def read_template(filename:str=None) -> dict:
+    """ the cloud-config of a cloud_init file, an empty one if there is no file """
+
+    if filename is None:
+        return {}
+
+    with open(filename, 'r') as infile:
+        template = yaml.safe_load(infile)
+        infile.close()
+
+    return template or {}
+
+
+def render(template:dict=None, name:str=None, files:[]=None, hosts:[]=None, runcmd:[]=None, phone_home:str=None) -> str:
+    """ renders the user-data of a node
+
+    Args:
+      template: cloud-config to start from, see read_template
+      name: node name, set as hostname and fqdn
+      files: write_files entries, see file_entry
+      hosts: /etc/hosts lines (eg "10.0.0.1 slurm.usegalaxy.no") appended on the node
+      runcmd: commands run at the end of the boot, after the template commands
+      phone_home: url the node posts its instance_id, hostname and fqdn to when the boot is done
+
+    Returns:
+      user-data (str)
+    """
+
+    cloud_config = dict(template or {})
+
+    if name is not None:
+        cloud_config['hostname'] = name.split('.')[0]
+        cloud_config['fqdn'] = name
+        cloud_config['preserve_hostname'] = False
+
+    write_files = list(cloud_config.get('write_files', None) or [])
+    write_files.extend(files or [])
+    if hosts:
+        write_files.append(file_entry('/etc/hosts', "\n".join(hosts) + "\n", append=True))
+    if write_files != []:
+        cloud_config['write_files'] = write_files
+
+    commands = list(cloud_config.get('runcmd', None) or [])
+    commands.extend(runcmd or [])
+    if commands != []:
+        cloud_config['runcmd'] = commands
+
+    if phone_home is not None:
+        cloud_config['phone_home'] = {'url': phone_home, 'post': ['instance_id', 'hostname', 'fqdn'], 'tries': 10}
+
+    return "#cloud-config\n" + yaml.safe_dump(cloud_config, default_flow_style=False, sort_keys=False)
@@ -0,0 +1,109 @@
+"""
+ In-memory stand-in for the CloudFlare client, for running and testing the DNS code offline
+
+ Only the calls used by cloudflare_utils are implemented:
+   cf.zones.get, cf.zones.dns_records.get/post/delete
+
+ Usage:
+   import ecc.cloudflare_fake as cloudflare_fake
+   cloudflare_utils.init(None, None, client=cloudflare_fake.CloudFlare(latency=0.2, failure_rate=0.1))
+"""
+
+import time
+import random
+import threading
+
+
+class CloudFlareAPIError(Exception):
+    pass
+
+
+class _DNSRecords(object):
+
+    def __init__(self, cf):
+        self._cf = cf
+
+    def get(self, zone_id:str, params:dict=None):
+        params = params or {}
+        self._cf._call()
+
+        table = [dict(record) for record in self._cf.records(zone_id).values()
+                 if 'name' not in params or record['name'] == params['name']]
+
+        table.sort(key=lambda record: record['id'])
+        if 'page' in params:
+            per_page = int(params.get('per_page', 20))
+            start = (int(params['page']) - 1) * per_page
+            table = table[start:start + per_page]
+
+        return table
+
+    def post(self, zone_id:str, data:dict):
+        self._cf._call()
+
+        with self._cf._lock:
+            self._cf._next_id += 1
+            record = dict(data)
+            record['id'] = "rec{}".format(self._cf._next_id)
+            self._cf.records(zone_id)[record['id']] = record
+
+        return dict(record)
+
+    def delete(self, zone_id:str, dns_record_id:str):
+        self._cf._call()
+
+        with self._cf._lock:
+            if dns_record_id not in self._cf.records(zone_id):
+                raise CloudFlareAPIError("Record {} does not exist".format(dns_record_id))
+
+            del self._cf.records(zone_id)[dns_record_id]
+
+        return {'id': dns_record_id}
+
+
+class _Zones(object):
+
+    def __init__(self, cf):
+        self._cf = cf
+        self.dns_records = _DNSRecords(cf)
+
+    def get(self, params:dict=None):
+        params = params or {}
+        self._cf._call()
+
+        return [{'id': zone_id, 'name': name} for name, zone_id in self._cf.zones_by_name.items()
+                if 'name' not in params or name == params['name']]
+
+
+class CloudFlare(object):
+    """ fake client
+
+    Args:
+      zone: name of the (only) zone
+      latency: seconds every api call takes
+      failure_rate: fraction of the calls that fail with a CloudFlareAPIError
+    """
+
+    def __init__(self, zone:str='usegalaxy.no', latency:float=0.0, failure_rate:float=0.0):
+        self.zones_by_name = {zone: "zone-{}".format(zone)}
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls = 0
+
+        self._records = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.zones = _Zones(self)
+
+    def records(self, zone_id:str) -> dict:
+        return self._records.setdefault(zone_id, {})
+
+    def _call(self):
+        with self._lock:
+            self.calls += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise CloudFlareAPIError("Injected failure")
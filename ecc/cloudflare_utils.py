@@ -3,44 +3,123 @@
 import argparse
 import os
 import sys
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from tabulate import tabulate
 import CloudFlare
+import kbr.log_utils as logger
 cf = None
 DEFAULT_ZONE = None
 
-def init(api_key:str, email:str, zone:str='usegalaxy.no'):
-    global DEFAULT_ZONE, cf
+# cached zone id of DEFAULT_ZONE, and name -> {record id: record} for the records we have seen
+ZONE_ID = None
+records = {}
+records_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """ thread safe token bucket, take() blocks till a token is available """
+
+    def __init__(self, rate:float=3.6, burst:int=120):
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._tokens = float(burst)
+        self._timestamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._burst, self._tokens + (now - self._timestamp) * self._rate)
+                self._timestamp = now
+
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+
+                wait = (1.0 - self._tokens) / self._rate
+
+            time.sleep(wait)
+
+
+# cloudflare allows 1200 calls per 5 minutes, not per second, so a batch can go out
+# in one burst. A full burst plus 5 minutes at the steady rate stays within the limit.
+rate_limiter = TokenBucket()
+
+
+def init(api_key:str, email:str, zone:str='usegalaxy.no', client=None, rate:float=3.6, burst:int=120):
+    """ sets up the cloudflare connection
+
+    Args:
+      api_key, email: cloudflare credentials
+      zone: the zone records are managed in
+      client: use this client instead of CloudFlare, eg the offline cloudflare_fake.CloudFlare
+      rate, burst: max api calls per second for the batch operations, and the burst allowed
+    """
+    global DEFAULT_ZONE, cf, ZONE_ID, records, rate_limiter
     DEFAULT_ZONE = zone
-    cf = CloudFlare.CloudFlare(email=email, token=api_key)
+    if client is not None:
+        cf = client
+    else:
+        cf = CloudFlare.CloudFlare(email=email, token=api_key)
+    ZONE_ID = None
+    records = {}
+    rate_limiter = TokenBucket(rate, burst)
 
 
+def zone_id() -> str:
+    """ the id of the default zone, looked up once """
 
-def list_records( ):
+    global ZONE_ID
+
+    if ZONE_ID is not None:
+        return ZONE_ID
 
     zone_name = DEFAULT_ZONE
-    
+
     # query for the zone name and expect only one value back
+    # raised rather than exiting, so the daemon retries on the next tick
     try:
         zones = cf.zones.get(params = {'name':zone_name,'per_page':1})
-    except CloudFlare.exceptions.CloudFlareAPIError as e:
-        exit('/zones.get %d %s - api call failed' % (e, e))
     except Exception as e:
-        exit('/zones.get - %s - api call failed' % (e))
+        raise RuntimeError('/zones.get - %s - api call failed' % (e))
 
     if len(zones) == 0:
-        exit('No zones found')
+        raise RuntimeError('No zones found for {}'.format(zone_name))
 
     # extract the zone_id which is needed to process that zone
-    zone = zones[0]
-    zone_id = zone['id']
+    ZONE_ID = zones[0]['id']
+    return ZONE_ID
+
+
+def _index_record(dns_record:dict) -> None:
+    with records_lock:
+        records.setdefault(dns_record['name'], {})[dns_record['id']] = dns_record
+
+
+def _unindex_record(dns_record_id:str) -> None:
+    with records_lock:
+        for name in list(records.keys()):
+            if dns_record_id in records[name]:
+                del records[name][dns_record_id]
+                if records[name] == {}:
+                    del records[name]
+
+
+def list_records( ):
+
+    zone = zone_id()
 
     page = 1
     table = []
     while True:
         # request the DNS records from that zone
         try:
-            dns_records = cf.zones.dns_records.get(zone_id, params={'page':page, 'page_size':20})
+            dns_records = cf.zones.dns_records.get(zone, params={'page':page, 'per_page':100})
         except CloudFlare.exceptions.CloudFlareAPIError as e:
             exit('/zones/dns_records.get %d %s - api call failed' % (e, e))
 
@@ -52,44 +131,193 @@ def list_records( ):
 
         page += 1
 
+    # a full listing, so the index can be rebuilt
+    with records_lock:
+        records.clear()
+    for dns_record in table:
+        _index_record(dns_record)
 
     return table
 
 
-def delete_record( dns_record_id:str ) -> None:
+def find_records( name:str ) -> []:
+    """ the records for a name, from the index or with a single name filtered lookup """
 
-    zone_name = DEFAULT_ZONE
+    if records.get(name, {}) != {}:
+        return list(records[name].values())
 
+    dns_records = cf.zones.dns_records.get(zone_id(), params={'name': name})
+    for dns_record in dns_records:
+        _index_record(dns_record)
 
-    zone_info = cf.zones.get(params={'name': zone_name})[0]
-    zone_id = zone_info['id']
-#    print( zone_id )
-    
-    r = cf.zones.dns_records.delete(zone_id, dns_record_id)
-    return r
+    return dns_records
 
-def add_record( r_type, r_name, r_value, r_ttl:int=1000 ) -> None:
 
+def records_for_names( names:[], concurrency:int=8, retries:int=3 ) -> []:
+    """ the records for a set of names, names not in the index are looked up in parallel, rate limited and retried """
 
-    zone_name = DEFAULT_ZONE
- #   print(f"ZN :: {zone_name}")
- #   print( cf.zones.get(params={'name': zone_name}) )
+    with records_lock:
+        lookups = [name for name in names if records.get(name, {}) == {}]
+
+    if lookups != []:
+        try:
+            # looked up once here rather than by every worker
+            zone_id()
+        except RuntimeError as e:
+            logger.debug("Error: {}".format(e))
+
+    for name, (ok, result) in zip(lookups, _run_batch(find_records, lookups, concurrency, retries)):
+        if not ok:
+            logger.warning("Could not look up the DNS records of {}: {}".format(name, result))
+
+    table = []
+    with records_lock:
+        for name in names:
+            table += list(records.get(name, {}).values())
+
+    return table
+
+
+def delete_record( dns_record_id:str ) -> None:
+
+    try:
+        r = cf.zones.dns_records.delete(zone_id(), dns_record_id)
+    finally:
+        # gone either way, a failed delete is most likely a record already removed
+        _unindex_record(dns_record_id)
+
+    return r
+
+def add_record( r_type, r_name, r_value, r_ttl:int=1000 ) -> None:
 
-    zone_info = cf.zones.get(params={'name': zone_name})[0]
-    zone_id = zone_info['id']
     data = {"type": r_type, "name": r_name, "content": r_value, "ttl": r_ttl}
     if r_type == "MX":
         data["priority"] = 10
+    r = None
     try:
-
-        r = cf.zones.dns_records.post(zone_id, data=data)
+        r = _add_record(data)
     except Exception as e:
-        print(e)
+        logger.warning("Could not add DNS record {} {} {}".format(r_type, r_name, r_value))
+        logger.debug("Error: {}".format(e))
 
     return r
 
 
+def _add_record( data:dict ) -> dict:
+    r = cf.zones.dns_records.post(zone_id(), data=data)
+    _index_record(r)
+    return r
+
+
 def purge_name(hostname):
-    for entry in list_records():
-        if entry['name'] == hostname:
-            delete_record(entry['id'])
\ No newline at end of file
+    for entry in find_records(hostname):
+        delete_record(entry['id'])
+
+
+def _with_retries(func, *args, retries:int=3, backoff:float=0.5):
+    """ rate limited call of func, retried with jittered exponential backoff """
+
+    attempt = 0
+    while True:
+        rate_limiter.take()
+        try:
+            return func(*args)
+        except Exception as e:
+            attempt += 1
+            if attempt > retries:
+                raise e
+
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
+
+
+def _run_batch(func, items:[], concurrency:int, retries:int) -> []:
+    """ runs func on every item on a bounded pool, returns a (ok, result/error) per item in order """
+
+    def run(item):
+        try:
+            return True, _with_retries(func, item, retries=retries)
+        except Exception as e:
+            return False, str(e)
+
+    if items == []:
+        return []
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(items)))) as executor:
+        return list(executor.map(run, items))
+
+
+def add_records( entries:[], concurrency:int=8, retries:int=3 ) -> []:
+    """ adds many records in parallel, rate limited and retried
+
+    Args:
+      entries: list of (type, name, value[, ttl]) tuples
+      concurrency: max calls in flight
+      retries: retries per record
+
+    Returns:
+      list of result dicts (name, value, ok, id, error), one per entry in order
+    """
+
+    datas = []
+    for entry in entries:
+        r_type, r_name, r_value = entry[0:3]
+        r_ttl = entry[3] if len(entry) > 3 else 1000
+        data = {"type": r_type, "name": r_name, "content": r_value, "ttl": r_ttl}
+        if r_type == "MX":
+            data["priority"] = 10
+        datas.append(data)
+
+    try:
+        # looked up once here rather than by every worker
+        zone_id()
+    except RuntimeError as e:
+        # every call retries the lookup, failures end up in the report
+        logger.debug("Error: {}".format(e))
+
+    report = []
+    for data, (ok, result) in zip(datas, _run_batch(_add_record, datas, concurrency, retries)):
+        report.append({'name': data['name'],
+                       'value': data['content'],
+                       'ok': ok,
+                       'id': result['id'] if ok else None,
+                       'error': None if ok else result})
+        if not ok:
+            logger.warning("Could not add DNS record {} {}: {}".format(data['name'], data['content'], result))
+
+    return report
+
+
+def delete_records( dns_record_ids:[], concurrency:int=8, retries:int=3 ) -> []:
+    """ deletes many records in parallel, rate limited and retried
+
+    Args:
+      dns_record_ids: ids of the records to delete
+      concurrency: max calls in flight
+      retries: retries per record
+
+    Returns:
+      list of result dicts (id, ok, error), one per record in order
+    """
+
+    try:
+        # looked up once here rather than by every worker
+        zone_id()
+    except RuntimeError as e:
+        # every call retries the lookup, failures end up in the report
+        logger.debug("Error: {}".format(e))
+
+    report = []
+    for dns_record_id, (ok, result) in zip(dns_record_ids, _run_batch(delete_record, dns_record_ids, concurrency, retries)):
+        report.append({'id': dns_record_id,
+                       'ok': ok,
+                       'error': None if ok else result})
+        if not ok:
+            logger.warning("Could not delete DNS record {}: {}".format(dns_record_id, result))
+
+    return report
+
+
+def purge_names( hostnames:[], concurrency:int=8, retries:int=3 ) -> []:
+    """ deletes all records of a set of names, see delete_records """
+
+    return delete_records([entry['id'] for entry in records_for_names(hostnames, concurrency, retries)], concurrency=concurrency, retries=retries)
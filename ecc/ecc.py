@@ -5,22 +5,33 @@
 # 
 # Kim Brugger (14 Sep 2018), contact: kim@brugger.dk
 
+import os
 import sys
 import re
+import json
+import math
+import time
 import pprint
 from ecc.utils import make_node_name
 
 pp = pprint.PrettyPrinter(indent=4)
 import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from munch import Munch
 import kbr.log_utils as logger
+import kbr.run_utils as run_utils
 
 import ecc.openstack_class as openstack_class
 import ecc.slurm_utils as slurm_utils
 import ecc.utils as ecc_utils
 import ecc.ansible_utils as ansible_utils
 import ecc.cloudflare_utils as cloudflare_utils
+import ecc.inventory_utils as inventory_utils
+import ecc.scale_utils as scale_utils
+import ecc.forecast_utils as forecast_utils
+import ecc.cloud_init_utils as cloud_init_utils
+import ecc.phone_home_utils as phone_home_utils
 
 # Not sure if this is still needed.
 import logging
@@ -35,9 +46,117 @@ config = None
 openstack = None
 nodes = {}
 
+# node lifecycle states
+REQUESTED = 'requested'
+BUILDING = 'building'
+CLOUD_INIT_DONE = 'cloud-init-done'
+DNS_REGISTERED = 'dns-registered'
+CONFIGURED = 'configured'
+IN_SLURM = 'in-slurm'
+DRAINING = 'draining'
+DELETED = 'deleted'
+# surplus nodes are stopped/shelved instead of deleted when the pool has hibernate set
+HIBERNATING = 'hibernating'
+HIBERNATED = 'hibernated'
+RESUMING = 'resuming'
+
+# states where a node is on its way into the cluster
+IN_FLIGHT_STATES = [REQUESTED, BUILDING, CLOUD_INIT_DONE, DNS_REGISTERED, CONFIGURED, RESUMING]
+
+# states of nodes that are leaving or out of the cluster, or not back in yet
+OUT_STATES = [DRAINING, DELETED, HIBERNATING, HIBERNATED, RESUMING]
+
+# openstack states of a hibernated node
+HIBERNATED_VM_STATES = ['shutoff', 'shelved', 'shelved_offloaded']
+
+# hibernate modes and the calls that hibernate a node
+HIBERNATE_MODES = ['stop', 'shelve']
+
+# slurm states of a node that is up and accepting or running jobs
+SLURM_UP_STATES = ['mix', 'idle', 'alloc', 'comp']
+
+# background playbook run for the nodes in dns-registered, only one at the time
+playbook_executor = ThreadPoolExecutor(max_workers=1)
+playbook_run = None
+# nodes were removed, so the controller needs its slurm.conf updated
+controller_reconfigure = False
+
+# node pools by name, see pool_configs
+node_pools = {}
+
+# seconds from request to in-slurm of the latest node boots, oldest first
+boot_times = []
+BOOT_HISTORY = 20
+
 def set_config(new_config:dict):
     global config
     config = new_config
+    # updated in place, the package (ecc.node_pools) holds on to this dict
+    node_pools.clear()
+    node_pools.update(pool_configs(config.ecc))
+    config.ecc.name_regex = names_regex(node_pools)
+
+
+def pool_configs(ecc_config:dict) -> dict:
+    """ the node pools, each pool has the ecc settings it does not override itself
+
+    Without a pools block the ecc block is the single pool 'default'. The pool
+    name is in 'pool' and name_regex is made from the pools name_template.
+    Pools with a baked_image (see bake_image) boot from it, the image they
+    were baked from is kept in base_image. A baked_image set in the ecc block
+    is baked from its image, so it is only used by the pools that do not set
+    an image of their own.
+
+    Returns:
+      dict of pool name: pool config (Munch)
+    """
+
+    defaults = {key: value for key, value in ecc_config.items() if key != 'pools'}
+    pools_settings = ecc_config.get('pools', None) or {'default': {}}
+
+    pools = {}
+    for name, settings in pools_settings.items():
+        settings = settings or {}
+        pool = Munch(defaults)
+        pool.update(settings)
+        pool['pool'] = name
+        pool['name_regex'] = pool.name_template.format(r"(\d+)")
+        pool['base_image'] = pool.get('image', None)
+        if 'image' in settings and 'baked_image' not in settings:
+            pool['baked_image'] = None
+        if pool.get('baked_image', None):
+            pool['image'] = pool.baked_image
+        pools[ name ] = pool
+
+    return pools
+
+
+def names_regex(pools:dict) -> str:
+    """ regex matching the node names of all the pools """
+
+    if len(pools) == 1:
+        return list(pools.values())[0].name_regex
+
+    return "|".join(["(?:{})".format(pool.name_regex) for pool in pools.values()])
+
+
+def node_pool(name:str) -> str:
+    """ the name of the pool a node belongs to, None for nodes outside the pools """
+
+    for pool in node_pools.values():
+        if re.fullmatch(pool.name_regex, name):
+            return pool.pool
+
+    return None
+
+
+def pool_config(pool:str=None) -> dict:
+    """ the config of a pool, default the first pool """
+
+    if pool is None:
+        return list(node_pools.values())[0]
+
+    return node_pools[ pool ]
 
 
 def openstack_connect(config):
@@ -45,8 +164,8 @@ def openstack_connect(config):
     openstack = openstack_class.Openstack()
     openstack.connect(**config)
 
-def servers(filter:str=None):
-    servers = openstack.servers()
+def servers(filter:str=None, cache:bool=True):
+    servers = openstack.servers(cache=cache)
 
     if filter:
         filter = re.compile(filter)
@@ -61,44 +180,85 @@ def servers(filter:str=None):
     return servers
 
 
+def new_node(name:str, state:str=None) -> dict:
+    return {'vm_id': None,
+            'name': name,
+            'pool': node_pool(name),
+            'ip': [],
+            'vm_state': None,
+            'slurm_state': 'na',
+            'state': state,
+            'state_timestamp': ecc_utils.timestamp(),
+            'timestamp': ecc_utils.timestamp()}
+
+
+def set_node_state(node:dict, state:str) -> None:
+    if node.get('state', None) != state:
+        logger.info("node {}: {} -> {}".format(node['name'], node.get('state', None), state))
+        node['state'] = state
+        node['state_timestamp'] = ecc_utils.timestamp()
+
+
 def update_nodes_status():
+    """ merges the current openstack and slurm view into the nodes dict
+
+    Nodes keep their lifecycle state between updates, nodes that are no
+    longer known by openstack or slurm are dropped unless they are still
+    waiting to be created.
+    """
     vnodes = servers(config.ecc.name_regex)
     snodes = slurm_utils.nodes()
 
     global nodes
-    nodes = {}
 
+    vm_names = set()
     for vnode in vnodes:
+        vm_names.add(vnode['name'])
         if vnode['name'] not in nodes:
-            nodes[vnode['name']] = {}
-            nodes[vnode['name']]['vm_id'] = vnode['id']
-            nodes[vnode['name']]['name'] = vnode['name']
-            nodes[vnode['name']]['ip'] = vnode.get('ip', [])
-            nodes[vnode['name']]['vm_state'] = vnode['status']
-            nodes[vnode['name']]['slurm_state'] = 'na'
-            nodes[vnode['name']]['timestamp'] = ecc_utils.timestamp()
-
-        elif 'vm_state' not in nodes[vnode['name']] or nodes[vnode['name']]['vm_state'] != vnode['status']:
-            nodes[vnode['name']]['vstate'] = vnode['status']
-            nodes[vnode['name']]['timestamp'] = ecc_utils.timestamp()
+            nodes[vnode['name']] = new_node(vnode['name'])
 
+        node = nodes[vnode['name']]
+        node['vm_id'] = vnode['id']
+        node['ip'] = vnode.get('ip', [])
+        if node['vm_state'] != vnode['status']:
+            node['vm_state'] = vnode['status']
+            node['timestamp'] = ecc_utils.timestamp()
 
+    slurm_names = set()
     for snode in snodes:
+        slurm_names.add(snode['name'])
         if snode['name'] not in nodes:
-            nodes[snode['name']] = {}
-            nodes[snode['name']]['vm_id'] = None
-            nodes[snode['name']]['name'] = snode['name']
-            nodes[snode['name']]['ip'] = []
-            nodes[snode['name']]['vm_state'] = None
-            nodes[snode['name']]['slurm_state'] = snode['state']
-            nodes[snode['name']]['timestamp'] = ecc_utils.timestamp()
+            nodes[snode['name']] = new_node(snode['name'])
+
+        node = nodes[snode['name']]
+        if node['slurm_state'] != snode['state']:
+            node['slurm_state'] = snode['state']
+            node['timestamp'] = ecc_utils.timestamp()
+
+    for name in list(nodes.keys()):
+        node = nodes[name]
+        if name not in vm_names and name not in slurm_names:
+            if node['state'] != REQUESTED:
+                del nodes[name]
+            continue
 
-        elif 'slurm_state' not in nodes[snode['name']]or nodes[snode['name']]['slurm_state'] != snode['state']:
-            nodes[snode['name']]['slurm_state'] = snode['state']
-            nodes[snode['name']]['timestamp'] = ecc_utils.timestamp()
+        if name not in vm_names and node['vm_id'] is not None:
+            node['vm_id'] = None
+            node['vm_state'] = None
 
+        if name not in slurm_names:
+            node['slurm_state'] = 'na'
 
-#    pp.pprint(nodes)
+        if 'pool' not in node:
+            node['pool'] = node_pool(name)
+
+        # nodes we did not create ourselves, or from before a restart without a state file
+        if node['state'] is None:
+            if node['slurm_state'] != 'na':
+                set_node_state(node, IN_SLURM)
+            else:
+                # re-adopted, the readiness check passes right away for a node that is already up
+                set_node_state(node, BUILDING)
 
 
 def nodes_info(update:bool=True):
@@ -110,7 +270,7 @@ def nodes_info(update:bool=True):
     return nodes
 
 
-def nodes_idle(update:bool=False):
+def nodes_idle(update:bool=False, pool:str=None):
 
     if update:
         update_nodes_status()
@@ -118,13 +278,17 @@ def nodes_idle(update:bool=False):
     count = 0
     for node in nodes:
         node = nodes[ node ]
+        if node.get('state', None) in OUT_STATES:
+            continue
+        if pool is not None and node.get('pool', None) != pool:
+            continue
         if node.get('slurm_state', None) in ['mix', 'idle'] and node.get('vm_state', None) == 'active':
             count += 1
 
     return count
 
 
-def nodes_total(update:bool=False):
+def nodes_total(update:bool=False, pool:str=None):
 
     if update:
         update_nodes_status()
@@ -132,25 +296,775 @@ def nodes_total(update:bool=False):
     count = 0
     for node in nodes:
         node = nodes[ node ]
+        if node.get('state', None) in OUT_STATES:
+            continue
+        if pool is not None and node.get('pool', None) != pool:
+            continue
         if node.get('slurm_state', None) in ['mix', 'idle', 'alloc'] and node.get('vm_state', None) == 'active':
             count += 1
 
     return count
 
 
+def nodes_ready(pool:str=None) -> int:
+    """ number of nodes up in slurm without any jobs, ie the spare nodes """
+
+    count = 0
+    for node in nodes.values():
+        if pool is not None and node.get('pool', None) != pool:
+            continue
+        if node.get('state', None) == IN_SLURM and node.get('slurm_state', None) == 'idle' and node.get('vm_state', None) == 'active':
+            count += 1
+
+    return count
+
+
+def nodes_in_flight(pool:str=None) -> int:
+    """ number of nodes requested but not in slurm yet """
+
+    count = 0
+    for node in nodes.values():
+        if pool is not None and node.get('pool', None) != pool:
+            continue
+        if node.get('state', None) in IN_FLIGHT_STATES:
+            count += 1
+
+    return count
+
+
+def idle_nodes_to_cull(count:int=1, pool:str=None) -> []:
+    nodes_to_cull = []
+    for n in nodes.values():
+        if pool is not None and n.get('pool', None) != pool:
+            continue
+        if n['slurm_state'] == 'idle' and n['vm_id'] is not None and n.get('state', None) == IN_SLURM:
+            nodes_to_cull.append(n)
+
+    return nodes_to_cull[0:count]
+
+
 def delete_idle_nodes(count:int=1):
     """ Delete idle nodes, by default one node is vm_deleted
     """
 
+    nodes_info()
+    delete_nodes( [n['vm_id'] for n in idle_nodes_to_cull(count)] )
+    return
 
-    nodes = nodes_info().values()
-    nodes_to_cull = []
-    for n in nodes:
-        if n['slurm_state'] == 'idle' and n['vm_id'] is not None:
-            nodes_to_cull.append(n['vm_id'])
 
-    delete_nodes( nodes_to_cull[0:count] )
-    return
+def hibernate_mode(pool:str=None) -> str:
+    """ how surplus nodes of a pool are hibernated (config hibernate: stop or shelve), None if they are deleted """
+
+    mode = pool_config(pool).get('hibernate', None)
+    if mode in HIBERNATE_MODES:
+        return mode
+
+    return None
+
+
+def drain_idle_nodes(count:int=1, pool:str=None) -> []:
+    """ Moves idle nodes into draining, they are deleted by advance_nodes
+
+    In pools with hibernate set they go into hibernating instead, and
+    advance_nodes stops or shelves them.
+
+    Returns:
+      names of the nodes being drained
+    """
+
+    names = []
+    for node in idle_nodes_to_cull(count, pool):
+        set_node_state(node, HIBERNATING if hibernate_mode(node.get('pool', None)) else DRAINING)
+        names.append(node['name'])
+
+    return names
+
+
+def forecast_nodes() -> int:
+    """ nodes the forecast demand needs by the time a node booted now is up, 0 unless config.ecc.prewarm is set """
+
+    if not config.ecc.get('prewarm', False):
+        return 0
+
+    return forecast_utils.nodes_needed(boot_time_estimate())
+
+
+def prewarm_nodes() -> int:
+    """ number of nodes to boot ahead of the forecast demand, they go to the first pool """
+
+    pool = pool_config()
+    needed = min(forecast_nodes(), int(pool.nodes_max)) - nodes_total(update=False) - nodes_in_flight()
+    room = int(pool.nodes_max) - nodes_total(update=False, pool=pool.pool) - nodes_in_flight(pool=pool.pool)
+
+    return max(0, min(needed, room))
+
+
+def spare_nodes(pool:str=None) -> int:
+    """ idle nodes a pool keeps ready for the next jobs
+
+    config nodes_spare, the first pool adds the nodes the jobs submitted
+    during a node boot need at the current arrival rate, up to
+    nodes_spare_max (default twice nodes_spare).
+    """
+
+    config_pool = pool_config(pool)
+    spare = int(config_pool.get('nodes_spare', 0))
+    spare_max = int(config_pool.get('nodes_spare_max', None) or 2 * spare)
+
+    if config_pool.pool == pool_config().pool and spare_max > spare:
+        arriving = forecast_utils.arrival_rate() * boot_time_estimate()
+        spare += int(math.ceil(arriving / (forecast_utils.jobs_per_node() or 1)))
+
+    return max(0, min(spare, spare_max, int(config_pool.nodes_max)))
+
+
+def nodes_floor(pool:str=None) -> int:
+    """ nodes a pool keeps when culling idle nodes: nodes_min, or what the forecast needs for the first pool """
+
+    config_pool = pool_config(pool)
+    floor = int(config_pool.nodes_min)
+    if config_pool.pool == pool_config().pool:
+        floor = max(floor, min(forecast_nodes(), int(config_pool.nodes_max)))
+
+    return floor
+
+
+def flavour(name:str=None) -> dict:
+    """ the openstack flavour info (id, name, cpus, ram, disk) of a flavour, default config.ecc.flavor """
+
+    if name is None:
+        name = config.ecc.flavor
+
+    for flavour_info in openstack.get_flavours():
+        if flavour_info['name'] == name or flavour_info['id'] == name:
+            return flavour_info
+
+    raise RuntimeError("Unknown flavour {}".format(name))
+
+
+def scale_reasons() -> []:
+    """ pending reasons that count as demand for more nodes, config.ecc.scale_reasons or slurm_utils.SCALABLE_REASONS """
+
+    return list(config.ecc.get('scale_reasons', None) or slurm_utils.SCALABLE_REASONS)
+
+
+def boot_time_estimate() -> int:
+    """ seconds a new node takes to get into slurm
+
+    The median of the latest node boots, config.ecc.boot_time until a
+    node has been booted.
+    """
+
+    if boot_times == []:
+        return int(config.ecc.get('boot_time', 300))
+
+    return int(sorted(boot_times)[len(boot_times) // 2])
+
+
+def scalable_jobs():
+    """ the pending jobs a new node can help with, generated one at the time
+
+    Jobs pending for a scale reason that slurm does not expect to start
+    before a new node would be up, see slurm_utils.start_times.
+    """
+
+    starts = slurm_utils.start_times()
+    ready = time.time() + boot_time_estimate()
+    for job in slurm_utils.pending_jobs(scale_reasons()):
+        start = starts.get(job['id'], None)
+        if start is not None and start <= ready:
+            continue
+        yield job
+
+
+def backlog_seconds() -> float:
+    """ seconds the free capacity of the slurm nodes needs to work through the pending core-seconds
+
+    Runtimes come from the job time limits and the sacct history, see
+    scale_utils.backlog_core_seconds. Jobs the free capacity cannot take
+    (see scale_utils.unplaced) wait for running jobs to end, and slurm does
+    not expect them to start before a new node is up (see scalable_jobs),
+    so the backlog is infinite then. Busy cpus are not counted.
+    """
+
+    jobs = list(scalable_jobs())
+    array_running = slurm_utils.snapshot()['array_running']
+    free = slurm_utils.free_capacity()
+
+    if scale_utils.unplaced(scale_utils.job_requests(jobs, array_running), free):
+        return float('inf')
+
+    runtimes = slurm_utils.job_history(int(config.ecc.get('history_refresh', 300)), int(config.ecc.get('history_days', 7)))
+    core_seconds = scale_utils.backlog_core_seconds(jobs, runtimes, array_running,
+                                                    int(config.ecc.get('default_runtime', 3600)))
+
+    cpus_free = sum([node[0] for node in free])
+    if cpus_free == 0:
+        return float('inf') if core_seconds else 0.0
+
+    return core_seconds / cpus_free
+
+
+def backlog_outlasts_boot() -> bool:
+    """ True if the pending jobs keep the nodes busy for longer than a node takes to boot """
+
+    seconds = backlog_seconds()
+    boot_time = boot_time_estimate()
+    logger.debug("backlog is {:.0f}s of work, a node boots in {}s".format(seconds, boot_time))
+
+    return seconds > boot_time
+
+
+def scale_out_plan() -> dict:
+    """ number of nodes per pool needed to run the pending jobs
+
+    Jobs that fit the free capacity of the nodes we have are left out, so
+    a job no node can take (eg a bigmem job) gets a node even when other
+    nodes are idle. Every group of pending job requests goes to the pool where it costs
+    the least per job (pool cost, default the flavour cpus, over the jobs
+    a node fits), the requests of a pool are then bin-packed onto its
+    flavour. Pools are capped by their nodes_max and the project quota.
+    node_memory_reserve (MB) is memory of a node slurm cannot use.
+
+    Returns:
+      dict of pool: number of nodes
+    """
+
+    candidates = {}
+    for name, pool in node_pools.items():
+        room = int(pool.nodes_max) - nodes_total(pool=name) - nodes_in_flight(pool=name)
+        if room <= 0:
+            continue
+
+        try:
+            node = flavour(pool.flavor)
+        except Exception as e:
+            logger.warning("Could not look up the flavour {} of pool {}".format(pool.flavor, name))
+            logger.debug("Error: {}".format(e))
+            continue
+
+        candidates[ name ] = {'cpus': node['cpus'],
+                              'ram': node['ram'],
+                              'memory': node['ram'] - int(pool.get('node_memory_reserve', 0)),
+                              'cost': float(pool.get('cost', None) or node['cpus']),
+                              'room': room}
+
+    if candidates == {}:
+        return {}
+
+    requests = scale_utils.job_requests(scalable_jobs(), slurm_utils.snapshot()['array_running'])
+    requests = scale_utils.unplaced(requests, slurm_utils.free_capacity())
+    plan = scale_utils.plan(requests, candidates, openstack.get_resources_available())
+
+    logger.debug("scale out plan: {}".format(plan))
+    return plan
+
+
+def request_nodes(count:int=1, cloud_init_file:str=None, pool:str=None) -> []:
+    """ Adds nodes in the requested state, they are brought up by advance_nodes
+
+    Args:
+      count: number of nodes
+      cloud_init_file: userdata file, default the cloud_init of the pool
+      pool: pool to add the nodes to, default the first pool
+
+    Returns:
+      names of the nodes requested
+    """
+
+    pool = pool_config(pool)
+    if cloud_init_file is None:
+        cloud_init_file = pool.get('cloud_init', None)
+
+    # hibernated nodes come back a lot faster than new ones
+    resumed = resume_nodes(count, pool.pool)
+    count -= len(resumed)
+
+    # slurm only nodes do not hold a name, their names are free to boot nodes with
+    names = openstack.server_names() + [n['name'] for n in nodes.values() if n.get('state', None) == REQUESTED]
+    requested = []
+    for _ in range(0, count):
+        node_name = pool.name_template.format( next_id(names=names + requested, regex=pool.name_regex))
+        node = new_node(node_name, REQUESTED)
+        node['requested_timestamp'] = node['state_timestamp']
+        node['pool'] = pool.pool
+        node['cloud_init'] = cloud_init_file
+        nodes[node_name] = node
+        requested.append(node_name)
+        logger.info("node {}: requested".format(node_name))
+
+    return resumed + requested
+
+
+def resume_nodes(count:int=1, pool:str=None) -> []:
+    """ Starts or unshelves hibernated nodes, they are taken back into slurm by advance_nodes
+
+    Returns:
+      names of the nodes resuming
+    """
+
+    names = []
+    for node in nodes.values():
+        if len(names) == count:
+            break
+        if node.get('state', None) != HIBERNATED or node['vm_id'] is None:
+            continue
+        if pool is not None and node.get('pool', None) != pool:
+            continue
+
+        try:
+            if node['vm_state'] in ['shelved', 'shelved_offloaded']:
+                openstack.server_unshelve(node['vm_id'])
+            else:
+                openstack.server_start(node['vm_id'])
+        except Exception as e:
+            # a new node is booted in its place
+            logger.warning("Could not resume node {}".format(node['name']))
+            logger.debug("Error: {}".format(e))
+            continue
+
+        node['drain_requested'] = False
+        node['hibernate_requested'] = False
+        node['resume_requested'] = False
+        set_node_state(node, RESUMING)
+        names.append(node['name'])
+
+    return names
+
+
+def node_reported_in(node:dict) -> bool:
+    """ is the boot of a node done
+
+    Nodes phone home with their own token when the listener runs (see
+    phone_home_utils), the console log is only polled for the end of the
+    boot as a fallback, for nodes that have not reported in after
+    config.ecc.phone_home_grace seconds.
+    """
+
+    # expected again, the listener does not know the tokens of the nodes booting when eccd was restarted
+    phone_home_utils.expect(node.get('phone_home_token', None))
+    if phone_home_utils.reported(node.get('phone_home_token', None)):
+        return True
+
+    if phone_home_utils.running() and ecc_utils.timestamp() - node['state_timestamp'] < int(config.ecc.get('phone_home_grace', 300)):
+        return False
+
+    return openstack.server_log_search(node['vm_id'], 'The ecc node is up', incremental=True) != []
+
+
+def self_configuring(pool:str=None) -> bool:
+    """ do the nodes of a pool get rendered user-data and join slurm by themselves (config render_cloud_init) """
+
+    return bool(pool_config(pool).get('render_cloud_init', False))
+
+
+def node_userdata(node_name:str, cloud_init_file:str=None, pool:str=None, phone_home_token:str=None) -> str:
+    """ rendered user-data for a node, None if the pool uses its cloud_init file as it is
+
+    The cloud_init file is the template. The node gets its name, the
+    slurm_conf and munge_key files of the pool, /etc/hosts entries for the
+    controller (controller_ip) and etc_hosts, and runs cloud_init_runcmd
+    (default: start munge and slurmd) at the end of the boot. With a
+    phone_home_url and a phone_home_token the node reports in to eccd
+    when its boot is done, at <phone_home_url>/<token>/$INSTANCE_ID/.
+    """
+
+    if not self_configuring(pool):
+        return None
+
+    settings = pool_config(pool)
+
+    files = []
+    if settings.get('slurm_conf', None):
+        with open(settings.slurm_conf, 'rb') as infile:
+            files.append(cloud_init_utils.file_entry('/etc/slurm/slurm.conf', infile.read()))
+    if settings.get('munge_key', None):
+        with open(settings.munge_key, 'rb') as infile:
+            files.append(cloud_init_utils.file_entry('/etc/munge/munge.key', infile.read(), owner='munge:munge', permissions='0400'))
+
+    hosts = list(settings.get('etc_hosts', None) or [])
+    if settings.get('controller', None) and settings.get('controller_ip', None):
+        hosts.append("{} {} {}".format(settings.controller_ip, settings.controller, settings.controller.split('.')[0]))
+
+    runcmd = settings.get('cloud_init_runcmd', None)
+    if runcmd is None:
+        runcmd = ['systemctl restart munge', 'systemctl restart slurmd']
+
+    phone_home = None
+    if settings.get('phone_home_url', None) and phone_home_token is not None:
+        phone_home = "{}/{}/$INSTANCE_ID/".format(settings.phone_home_url.rstrip('/'), phone_home_token)
+
+    return cloud_init_utils.render(cloud_init_utils.read_template(cloud_init_file), node_name, files, hosts, list(runcmd),
+                                   phone_home=phone_home)
+
+
+def advance_nodes() -> None:
+    """ Moves every node that is not settled one step along its lifecycle
+
+    requested -> building -> cloud-init-done -> dns-registered -> configured -> in-slurm
+    draining -> deleted
+    hibernating -> hibernated -> resuming -> in-slurm
+
+    None of the steps block for long, waiting is done by checking again on the next call.
+    """
+
+    for node in list(nodes.values()):
+        try:
+            advance_node(node)
+        except Exception as e:
+            logger.warning("Could not advance node {} in state {}".format(node['name'], node.get('state', None)))
+            logger.debug("Error: {}".format(e))
+
+    advance_dns()
+    advance_teardown()
+    # the playbook runs against the inventory, so it has to list the nodes it is run for
+    write_inventory_cache()
+    advance_playbook()
+    save_nodes()
+
+
+def write_inventory_cache(vms:[]=None) -> None:
+    """ writes the VMs to the inventory cache served by ecc_nodes.py
+
+    Args:
+      vms: list of dicts with name and ip, default the VMs of the nodes the daemon follows
+    """
+
+    if vms is None:
+        vms = [node for node in nodes.values() if node['vm_id'] is not None and node.get('state', None) != DELETED]
+
+    inventory_utils.write_cache(inventory_utils.cache_file(config.ecc), config.ecc.ansible_dir, vms)
+
+
+def refresh_inventory_cache() -> None:
+    """ writes the VMs of the pools, from a fresh server listing, to the inventory cache
+
+    For the playbook runs outside the daemon (ecc-cli add/delete/run-playbook),
+    they do not know the node states the daemon keeps.
+    """
+
+    write_inventory_cache(servers(names_regex(node_pools), cache=False))
+
+
+def advance_dns() -> None:
+    """ Registers all nodes in cloud-init-done in DNS with one batch call """
+
+    ready = [node for node in nodes.values() if node.get('state', None) == CLOUD_INIT_DONE]
+    if ready == []:
+        return
+
+    for node in ready:
+        if node['ip'] == []:
+            node['ip'] = openstack.server_ip(node['vm_id'])
+
+    ready = [node for node in ready if node['ip'] != []]
+    report = cloudflare_utils.add_records([('A', node['name'], node['ip'][0], 1000) for node in ready])
+
+    global controller_reconfigure
+
+    for node, result in zip(ready, report):
+        if not result['ok']:
+            # ansible reaches the node by ip, so it can carry on without the DNS entry
+            logger.warning("node {} has no DNS entry: {}".format(node['name'], result['error']))
+
+        if self_configuring(node.get('pool', None)):
+            # the node joins slurm by itself, the playbook only runs for the controller if needed
+            if slurm_conf_changes(added=[node['name']]):
+                controller_reconfigure = True
+            set_node_state(node, CONFIGURED)
+        else:
+            set_node_state(node, DNS_REGISTERED)
+
+
+def slurm_state(node:dict) -> str:
+    """ the sinfo state of a node without the flag suffixes (eg the * of a not responding node), 'na' if not in slurm """
+
+    return (node.get('slurm_state', None) or 'na').rstrip('*~#%$@^-!')
+
+
+def slurm_drained(node:dict) -> bool:
+    """ can the node go without cutting off a job: drained, down or not in slurm """
+
+    return slurm_state(node) in ['drain', 'down', 'fail', 'na']
+
+
+def advance_teardown() -> None:
+    """ Deletes all drained nodes with a VM in one bulk teardown """
+
+    drained = [node for node in nodes.values() if node.get('state', None) == DRAINING and
+               node['vm_id'] is not None and slurm_drained(node)]
+    if drained == []:
+        return
+
+    global controller_reconfigure
+
+    names = teardown_nodes( [node['vm_id'] for node in drained], confirm=False )
+    for node in drained:
+        set_node_state(node, DELETED)
+
+    if names != [] and slurm_conf_changes(removed=names):
+        controller_reconfigure = True
+
+
+def boot_timed_out(node:dict) -> bool:
+    """ has the node been on its way into the cluster for longer than boot_timeout
+
+    The time is counted from the request, so a node stuck in any of the
+    steps times out, nodes adopted on the way in count from when they were found.
+    """
+
+    started = node.get('requested_timestamp', None) or node['state_timestamp']
+    return ecc_utils.timestamp() - started > int(config.ecc.get('boot_timeout', 600))
+
+
+def advance_node(node:dict) -> None:
+    state = node.get('state', None)
+
+    # a stuck node holds back all scaling, as that waits for the nodes in flight
+    if state in [REQUESTED, CLOUD_INIT_DONE, DNS_REGISTERED, CONFIGURED] and boot_timed_out(node):
+        logger.warning("node {} timed out in state {}".format(node['name'], state))
+        set_node_state(node, DRAINING)
+        return
+
+    if state == REQUESTED:
+        # a secret per boot, so only this node can report itself as booted
+        if node.get('phone_home_token', None) is None:
+            node['phone_home_token'] = phone_home_utils.new_token()
+        phone_home_utils.expect(node['phone_home_token'])
+
+        node['vm_id'] = openstack.server_create( name=node['name'],
+                                                 userdata_file=node.get('cloud_init', None),
+                                                 userdata=node_userdata(node['name'], node.get('cloud_init', None), node.get('pool', None),
+                                                                        node['phone_home_token']),
+                                                 wait=False,
+                                                 **pool_config(node.get('pool', None)) )
+        set_node_state(node, BUILDING)
+
+    elif state == BUILDING:
+        if node['vm_state'] == 'error' or ecc_utils.timestamp() - node['state_timestamp'] > int(config.ecc.get('boot_timeout', 600)):
+            logger.warning("node {} did not come up, vm-state: {}".format(node['name'], node['vm_state']))
+            openstack.server_log_reset(node['vm_id'])
+            set_node_state(node, DRAINING)
+
+        elif node['vm_state'] == 'active' and node_reported_in(node):
+            openstack.server_log_reset(node['vm_id'])
+            phone_home_utils.forget(node.get('phone_home_token', None))
+            set_node_state(node, CLOUD_INIT_DONE)
+
+    # nodes in cloud-init-done are registered together in advance_dns
+
+    elif state == CONFIGURED:
+        if node['slurm_state'] in SLURM_UP_STATES:
+            set_node_state(node, IN_SLURM)
+            if node.get('requested_timestamp', None) is not None:
+                boot_times.append(node['state_timestamp'] - node['requested_timestamp'])
+                del boot_times[:-BOOT_HISTORY]
+
+    elif state == DRAINING:
+        # a node that timed out may still phone home, it must not count for the next node of the name
+        phone_home_utils.forget(node.get('phone_home_token', None))
+
+        if node['vm_id'] is None:
+            set_node_state(node, DELETED)
+            return
+
+        # slurm has to drain the node first, so no job is on it or lands on it when it goes
+        if not node.get('drain_requested', False) or slurm_state(node) in ['idle', 'mix', 'alloc']:
+            slurm_utils.set_node_drain(node['name'], 'ecc: scaling down')
+            node['drain_requested'] = True
+
+        # drained nodes with a VM are torn down together in advance_teardown
+
+    elif state == HIBERNATING:
+        # the slurm definition and the DNS entry stay, slurm just does not schedule on the node
+        if not node.get('drain_requested', False):
+            slurm_utils.set_node_drain(node['name'], 'ecc: hibernating')
+            node['drain_requested'] = True
+            return
+
+        if node['vm_id'] is None:
+            set_node_state(node, DRAINING)
+        elif node['vm_state'] in HIBERNATED_VM_STATES:
+            set_node_state(node, HIBERNATED)
+        elif slurm_state(node) in ['idle', 'mix', 'alloc']:
+            # the drain did not take, ask again
+            slurm_utils.set_node_drain(node['name'], 'ecc: hibernating')
+        elif not slurm_drained(node):
+            # drng, comp: wait till slurm has the node drained, so no job is cut off
+            return
+        elif not node.get('hibernate_requested', False):
+            if hibernate_mode(node.get('pool', None)) == 'shelve':
+                openstack.server_shelve(node['vm_id'])
+            else:
+                openstack.server_stop(node['vm_id'], wait=False)
+            node['hibernate_requested'] = True
+
+    elif state == HIBERNATED:
+        # deleted behind our back
+        if node['vm_id'] is None:
+            set_node_state(node, DRAINING)
+
+    elif state == RESUMING:
+        if node['vm_id'] is None or node['vm_state'] == 'error' or \
+           ecc_utils.timestamp() - node['state_timestamp'] > int(config.ecc.get('boot_timeout', 600)):
+            logger.warning("node {} did not resume, vm-state: {}".format(node['name'], node['vm_state']))
+            set_node_state(node, DRAINING)
+
+        elif node['slurm_state'] in SLURM_UP_STATES:
+            set_node_state(node, IN_SLURM)
+
+        elif node['vm_state'] == 'active' and not node.get('resume_requested', False):
+            slurm_utils.set_node_resume(node['name'])
+            node['resume_requested'] = True
+
+    elif state == DELETED:
+        del nodes[ node['name'] ]
+
+
+def advance_playbook() -> None:
+    """ Runs the playbook in the background for nodes in dns-registered, and moves them on to configured when it is done """
+
+    global playbook_run, controller_reconfigure
+
+    if playbook_run is not None:
+        if not playbook_run['future'].done():
+            return
+
+        try:
+            result = playbook_run['future'].result()
+        except Exception as e:
+            logger.debug("Error: {}".format(e))
+            result = None
+
+        if result is None:
+            logger.warning("playbook run failed, will retry")
+            controller_reconfigure = controller_reconfigure or playbook_run['controller']
+        else:
+            for name in playbook_run['names']:
+                if name in nodes and nodes[name]['state'] == DNS_REGISTERED:
+                    set_node_state(nodes[name], CONFIGURED)
+
+        playbook_run = None
+
+    names = [node['name'] for node in nodes.values() if node.get('state', None) == DNS_REGISTERED]
+    if names == [] and not controller_reconfigure:
+        return
+
+    slurm_conf_changed = controller_reconfigure or slurm_conf_changes(names)
+    hosts = playbook_hosts(names, slurm_conf_changed)
+    controller_reconfigure = False
+
+    logger.info('running playbook for {}'.format(", ".join(hosts) if hosts is not None else 'all hosts'))
+    future = playbook_executor.submit(ansible_utils.run_playbook, playbook_cmd(names), cwd=config.ecc.ansible_dir, hosts=hosts)
+    playbook_run = {'future': future, 'names': names, 'controller': slurm_conf_changed}
+
+
+def slurm_conf_changes(added:[]=None, removed:[]=None) -> bool:
+    """ does adding/removing these nodes change slurm.conf on the controller
+
+    With config.ecc.static_slurm_nodes the cloud nodes are predefined in
+    slurm.conf and it never changes, otherwise it does for every removed
+    node and for added nodes slurm does not know about yet.
+    """
+
+    if config.ecc.get('static_slurm_nodes', False):
+        return False
+
+    if removed:
+        return True
+
+    if added:
+        slurm_names = slurm_utils.node_names()
+        for name in added:
+            if name not in slurm_names:
+                return True
+
+    return False
+
+
+def playbook_cmd(names:[]=None) -> str:
+    """ the playbook that configures the new nodes names
+
+    Nodes booted from a baked image only need the per node delta,
+    config.ecc.baked_ansible_cmd. If any of the nodes is not, or there
+    are no nodes, the full config.ecc.ansible_cmd is used.
+    """
+
+    if not names or not config.ecc.get('baked_ansible_cmd', None):
+        return config.ecc.ansible_cmd
+
+    for name in names:
+        pool = node_pools.get(nodes.get(name, {}).get('pool', None) or node_pool(name), None)
+        if pool is None or not pool.get('baked_image', None):
+            return config.ecc.ansible_cmd
+
+    return config.ecc.baked_ansible_cmd
+
+
+def playbook_hosts(hosts:[], slurm_conf_changed:bool=True) -> []:
+    """ the hosts to limit a playbook run to, None is the whole inventory
+
+    The controller (config.ecc.controller) is added when slurm.conf changes,
+    if no controller is configured the whole inventory is used instead,
+    without the hibernating, hibernated and resuming nodes.
+    """
+
+    if not slurm_conf_changed:
+        return list(hosts)
+
+    controller = config.ecc.get('controller', None)
+    if controller is None:
+        # the whole inventory, less the VMs that are (being) stopped or shelved as ansible cannot reach them.
+        # They stay in the inventory so the slurm.conf built from it keeps their definition.
+        asleep = sorted([node['name'] for node in nodes.values() if node.get('state', None) in [HIBERNATING, HIBERNATED, RESUMING]])
+        if asleep == []:
+            return None
+        return ['all'] + ["!{}".format(name) for name in asleep]
+
+    return list(hosts) + [controller]
+
+
+def nodes_state_file() -> str:
+    return config.ecc.get('state_file', 'ecc_nodes.json')
+
+
+def save_nodes() -> None:
+    """ persists the nodes, their lifecycle states, the boot times and the demand forecast """
+
+    filename = nodes_state_file()
+    with open(f"{filename}.tmp", 'w') as outfile:
+        json.dump({'nodes': nodes, 'boot_times': boot_times, 'forecast': forecast_utils.state()}, outfile, indent=2)
+        outfile.close()
+
+    os.replace(f"{filename}.tmp", filename)
+
+
+def load_nodes() -> None:
+    """ reads in the nodes persisted by save_nodes, if any """
+
+    global nodes, boot_times
+
+    filename = nodes_state_file()
+    if not os.path.isfile(filename):
+        forecast_utils.load(None, int(config.ecc.get('forecast_bucket', forecast_utils.BUCKET)))
+        return
+
+    with open(filename, 'r') as infile:
+        state = json.load(infile)
+        infile.close()
+
+    # older state files only have the nodes
+    if 'nodes' not in state or not isinstance(state.get('boot_times', None), list):
+        state = {'nodes': state, 'boot_times': []}
+
+    nodes = state['nodes']
+    boot_times = state['boot_times']
+    forecast_utils.load(state.get('forecast', None), int(config.ecc.get('forecast_bucket', forecast_utils.BUCKET)))
+
+    # the background playbook run did not survive the restart
+    for node in nodes.values():
+        if node.get('state', None) == DNS_REGISTERED:
+            node['state_timestamp'] = ecc_utils.timestamp()
 
 
 def delete_node(ids:str):
@@ -163,68 +1077,286 @@ def delete_nodes(ids:[]):
     if not isinstance( ids, list):
         ids = [ids]
 
-    for id in ids:
-        if id is None:
-            continue 
-        logger.info("deleting node {}".format( id ))
-        vm = openstack.server( id )
+    ids = [id for id in ids if id is not None]
+    if ids == []:
+        return
+
+    names = teardown_nodes( ids )
+    if names == []:
+        return
+
+    # slurm.conf is rendered from the inventory, the deleted nodes have to go from it
+    refresh_inventory_cache()
 
-        logger.info('deleting DNS entry...')
-        cloudflare_utils.purge_name( vm['name'])
-        logger.info('deleting VM...')
-        openstack.server_delete( id )
+    if not slurm_conf_changes(removed=names):
+        return
 
     logger.info('running playbook')
-    ansible_utils.run_playbook(config.ecc.ansible_cmd, cwd=config.ecc.ansible_dir)
+    ansible_utils.run_playbook(config.ecc.ansible_cmd, cwd=config.ecc.ansible_dir, hosts=playbook_hosts([]))
 
     return
 
 
+def teardown_nodes(ids:[], concurrency:int=None, timeout:int=120, confirm:bool=True) -> []:
+    """ Deletes the VMs and DNS entries of a set of nodes in bulk
 
+    The VMs are resolved from a single server listing and the DNS records
+    from the cloudflare record index, the deletes are then run in parallel and
+    the removal is confirmed by polling the server listing.
 
-def create_nodes(cloud_init_file:str=None, count=1):
+    Args:
+      ids: vm ids or names of the nodes
+      concurrency: max number of deletes running at the same time, default config.ecc.delete_concurrency or 8
+      timeout: max time (s) to wait for the VMs to disappear
+      confirm: wait for the VMs to disappear from the server listing
 
+    Returns:
+      names of the nodes torn down
+    """
 
-#    resources = openstack.get_resources_available()
-    global nodes
+    if concurrency is None:
+        concurrency = int(config.ecc.get('delete_concurrency', 8))
 
-    try:
-        for _ in range(0, count):
-            node_id = next_id(names=openstack.server_names())
-            node_name = config.ecc.name_template.format( node_id)
-            print(f"creating node with name {node_name}")
+    vms = {}
+    for server in openstack.servers():
+        if server['id'] in ids or server['name'] in ids:
+            vms[ server['id'] ] = server['name']
 
-            node_id = openstack.server_create( name=node_name,
-                                           userdata_file=cloud_init_file,
-                                           **config.ecc )
+    for id in ids:
+        if id not in vms and id not in vms.values():
+            logger.warning("Unknown node {}, cannot delete it".format( id ))
+
+    if vms == {}:
+        return []
+
+    names = list(vms.values())
+    logger.info("deleting nodes {}".format( ", ".join(names) ))
 
-            logger.debug("Execute server {}/{} is vm_booting".format( node_id, node_name))
-            # This is a blocking call, so will hang here till the server is online.
-            openstack.wait_for_log_entry(node_id)
-            node_ips = openstack.server_ip(node_id)
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {}
+        for vm_id in vms:
+            futures[ executor.submit(openstack.server_delete, vm_id, check=False) ] = f"VM {vms[ vm_id ]}"
+        # the record lookup runs in the pool as well, so a cloudflare failure does not hold up the VM deletes
+        futures[ executor.submit(cloudflare_utils.purge_names, names, concurrency) ] = f"DNS records {', '.join(names)}"
+
+        for future in as_completed(futures):
             try:
-                cloudflare_utils.add_record('A', node_name, node_ips[0], 1000)
-            except:
-                print(f"failed to add dns entry: 'add_record('A', {node_name}, {node_ips[0]}, 1000)'")
+                future.result()
+            except Exception as e:
+                logger.warning("Could not delete {}".format( futures[ future ]))
+                logger.debug("Error: {}".format(e))
 
-            nodes[node_name] = {}
-            nodes[node_name]['vm_id'] = node_id
-            nodes[node_name]['vm_state'] = 'booting'
-            nodes[node_name] = node_ips
+    end_time = ecc_utils.timestamp() + timeout
+    while confirm:
+        remaining = [server['name'] for server in openstack.servers(cache=False) if server['id'] in vms]
+        if remaining == []:
+            break
 
+        if ecc_utils.timestamp() > end_time:
+            logger.warning("VMs not deleted within {}s: {}".format( timeout, ", ".join(remaining)))
+            break
 
-    except Exception as e:
-        logger.warning("Could not create execute server")
-        logger.debug("Error: {}".format(e))
-        return
+        time.sleep(2)
+
+    return names
+
+
+def create_node(node_name:str, cloud_init_file:str=None, pool:str=None) -> dict:
+    """ boots a single node, waits for it to come up and registers it in DNS
+
+    This is the per node part of create_nodes, it is blocking and thread safe
+    so several nodes can be brought up at the same time.
+    """
+
+    node_id = openstack.server_create( name=node_name,
+                                       userdata_file=cloud_init_file,
+                                       userdata=node_userdata(node_name, cloud_init_file, pool),
+                                       **pool_config(pool) )
+
+    logger.debug("Execute server {}/{} is vm_booting".format( node_id, node_name))
+    try:
+        # This is a blocking call, so will hang here till the server is online.
+        openstack.wait_for_log_entry(node_id)
+        node_ips = openstack.server_ip(node_id)
+        cloudflare_utils.add_record('A', node_name, node_ips[0], 1000)
+    except Exception:
+        # do not leave a half booted VM behind holding the name and quota
+        logger.warning("Bringing up {} failed, deleting the VM".format(node_name))
+        openstack.server_delete(node_id, check=False)
+        raise
+
+    node = new_node(node_name, DNS_REGISTERED)
+    node.update({'vm_id': node_id, 'ip': node_ips, 'vm_state': 'booting'})
+    return node
+
+
+def create_nodes(cloud_init_file:str=None, count=1, concurrency:int=None, pool:str=None):
+    """ Creates count nodes, the nodes are booted in parallel followed by a single playbook run
+
+    Args:
+      cloud_init_file: userdata file for the nodes
+      count: number of nodes to create
+      concurrency: max number of nodes booting at the same time, default config.ecc.create_concurrency or 4
+      pool: pool to create the nodes in, default the first pool
+
+    Returns:
+      list of names of the nodes created
+    """
+
+    global nodes
+
+    if concurrency is None:
+        concurrency = int(config.ecc.get('create_concurrency', 4))
+    concurrency = max(1, min(concurrency, count))
+
+    pool = pool_config(pool)
+    names = openstack.server_names()
+    node_names = []
+    for _ in range(0, count):
+        node_id = next_id(names=names + node_names, regex=pool.name_regex)
+        node_names.append(pool.name_template.format( node_id))
+
+    created = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {}
+        for node_name in node_names:
+            print(f"creating node with name {node_name}")
+            futures[ executor.submit(create_node, node_name, cloud_init_file, pool.pool) ] = node_name
+
+        for future in as_completed(futures):
+            try:
+                node = future.result()
+            except Exception as e:
+                logger.warning("Could not create execute server {}".format(futures[ future ]))
+                logger.debug("Error: {}".format(e))
+                continue
+
+            nodes[ node['name'] ] = node
+            created.append( node['name'] )
+
+    if created == []:
+        return created
 
     try:
-        ansible_utils.run_playbook(config.ecc.ansible_cmd, cwd=config.ecc.ansible_dir)
+        # the playbook is limited to the new nodes, so they have to be in the inventory
+        refresh_inventory_cache()
+        hosts = playbook_hosts(created, slurm_conf_changes(added=created))
+        if ansible_utils.run_playbook(playbook_cmd(created), cwd=config.ecc.ansible_dir, hosts=hosts) is not None:
+            for node_name in created:
+                set_node_state(nodes[node_name], CONFIGURED)
     except:
-        print(f"failed to run playbook: 'run_playbook({config.ecc.ansible_cmd}, host={node_ips[0]}, cwd={config.ecc.ansible_dir})'")
-        return
+        print(f"failed to run playbook: 'run_playbook({config.ecc.ansible_cmd}, cwd={config.ecc.ansible_dir})'")
+
+    return created
+
+
+def baked_images(prefix:str=None) -> []:
+    """ the versions of the baked image, oldest first
+
+    Returns:
+      list of (version, image info) tuples
+    """
+
+    if prefix is None:
+        prefix = config.ecc.get('bake_name', 'ecc-node')
+
+    regex = re.compile(r'^{}-v(\d+)$'.format(re.escape(prefix)))
+    images = []
+    for image in openstack.get_images(active=False, name=prefix):
+        match = regex.match(image['name'])
+        if match is not None:
+            images.append((int(match.group(1)), image))
+
+    return sorted(images, key=lambda version: version[0])
+
+
+def bake_image(keep:int=None) -> dict:
+    """ bakes a new version of the node image
+
+    A VM is booted from config.ecc.image, the image of the pools that use
+    the baked image (see pool_configs), with the settings of the first pool.
+    It is configured with config.ecc.bake_ansible_cmd (required, it has to
+    reach the VM by its {ip}, eg with -i {ip},), cleaned with
+    config.ecc.bake_clean_cmd, stopped and snapshotted into
+    <bake_name>-v<version>. Both commands are
+    formatted with the {ip} and {name} of the VM, its name is outside the
+    node names so neither the daemon nor the node inventory pick it up.
+    The VM is deleted afterwards, and all but the latest keep versions
+    (default config.ecc.bake_keep or 3) are garbage collected.
+
+    Returns:
+      dict with id, name and version of the image
+
+    Raises:
+      RuntimeError if image or bake_ansible_cmd is not set, or the VM could not be configured or cleaned
+    """
+
+    # the node inventory leaves the bake VM out, so ansible_cmd would snapshot an unconfigured VM
+    cmd = config.ecc.get('bake_ansible_cmd', None)
+    if cmd is None:
+        raise RuntimeError("bake_ansible_cmd is not set, cannot configure the VM to bake")
+
+    base_image = config.ecc.get('image', None)
+    if base_image is None:
+        raise RuntimeError("no image in the ecc block to bake from")
+
+    if keep is None:
+        keep = int(config.ecc.get('bake_keep', 3))
+
+    prefix = config.ecc.get('bake_name', 'ecc-node')
+    versions = baked_images(prefix)
+    version = versions[-1][0] + 1 if versions else 1
+    image_name = f"{prefix}-v{version}"
+    vm_name = f"{image_name}-bake"
+
+    pool = pool_config()
+    settings = dict(pool)
+    settings['image'] = base_image
+
+    logger.info("baking image {} from {}".format(image_name, base_image))
+    vm_id = openstack.server_create( name=vm_name, userdata_file=pool.get('cloud_init', None), **settings )
+    try:
+        openstack.wait_for_log_entry(vm_id)
+        ip = openstack.server_ip(vm_id)[0]
+
+        if ansible_utils.run_playbook(cmd.format(ip=ip, name=vm_name), cwd=config.ecc.ansible_dir) is None:
+            raise RuntimeError("could not configure {}".format(vm_name))
+
+        clean_cmd = config.ecc.get('bake_clean_cmd', None)
+        if clean_cmd is not None:
+            run = run_utils.launch_cmd(clean_cmd.format(ip=ip, name=vm_name), cwd=config.ecc.ansible_dir)
+            if run.p_status != 0:
+                raise RuntimeError("could not clean {}: {}".format(vm_name, run.stderr))
+
+        openstack.server_stop(vm_id)
+        image_id = openstack.image_create(vm_id, image_name)
+    finally:
+        openstack.server_delete(vm_id, check=False)
+
+    logger.info("baked image {} ({})".format(image_name, image_id))
+    gc_baked_images(keep, prefix)
+
+    return {'id': image_id, 'name': image_name, 'version': version}
+
+
+def gc_baked_images(keep:int=3, prefix:str=None) -> []:
+    """ deletes all but the latest keep versions of the baked image, never the one in use
+
+    Returns:
+      names of the images deleted
+    """
+
+    in_use = config.ecc.get('baked_image', None)
+    deleted = []
+    for _, image in baked_images(prefix)[:-keep or None]:
+        if image['id'] == in_use or image['name'] == in_use:
+            continue
+
+        openstack.image_delete(image['id'])
+        deleted.append(image['name'])
+        logger.info("deleted old baked image {}".format(image['name']))
 
-    return node_name
+    return deleted
 
 
 def next_id(names, regex:str=None) -> int:
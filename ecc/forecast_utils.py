@@ -0,0 +1,249 @@
+"""
+ Demand forecast from the queue history, so nodes can be booted ahead of the jobs
+
+ Every daemon tick is recorded, the ticks are averaged into buckets (default
+ 15 minutes) and the bucket averages of the job demand (pending + running)
+ feed an additive Holt-Winters model with a weekly season. The seasonal
+ terms start at zero and each is learned from the first bucket of its slot
+ on, so during the first week they only hold a GAMMA share of how far that
+ bucket was off the level, and the model is close to a plain trended EWMA.
+
+ The state is a small dict (level, trend, one float per bucket of the week
+ and the error statistics), so it is persisted with the node states.
+"""
+
+import math
+import time
+from collections import deque
+
+import kbr.log_utils as logger
+
+
+BUCKET = 900
+SEASON = 7 * 24 * 3600
+
+# smoothing of the level, trend and season
+ALPHA = 0.3
+BETA = 0.05
+GAMMA = 0.2
+
+# weight of the latest bucket in the error averages
+ERROR_WEIGHT = 0.05
+
+# seconds the job arrival rate is averaged over
+ARRIVAL_WINDOW = 900
+
+# the latest ticks: timestamp, pending, running, nodes, idle
+samples = deque(maxlen=1000)
+
+_state = None
+
+
+def reset(bucket:int=BUCKET, season:int=SEASON) -> None:
+    global _state
+    _state = {'bucket_size': bucket,
+              'season_size': season,
+              'bucket': None,
+              'sum': 0.0,
+              'count': 0,
+              'level': None,
+              'trend': 0.0,
+              'season': [0.0] * max(1, season // bucket),
+              'seasons_seen': 0,
+              'jobs_per_node': None,
+              'forecast': None,
+              'error': {'buckets': 0, 'mae': 0.0, 'bias': 0.0, 'last': None},
+              'last_job_id': None,
+              'last_job_time': None,
+              'arrival_rate': 0.0}
+
+
+def state() -> dict:
+    return _state
+
+
+def load(saved:dict=None, bucket:int=BUCKET, season:int=SEASON) -> None:
+    """ restores a state from state(), starts afresh if there is none or the bucket/season size changed """
+
+    if saved is None or saved.get('bucket_size', None) != bucket or saved.get('season_size', None) != season:
+        reset(bucket, season)
+        return
+
+    global _state
+    _state = saved
+    # states saved before the arrival rate was followed
+    _state.setdefault('last_job_id', None)
+    _state.setdefault('last_job_time', None)
+    _state.setdefault('arrival_rate', 0.0)
+
+
+def _slot(timestamp:float) -> int:
+    """ bucket of the season the timestamp is in, the week starts monday 00:00 local time """
+
+    t = time.localtime(timestamp)
+    seconds = t.tm_wday * 86400 + t.tm_hour * 3600 + t.tm_min * 60 + t.tm_sec
+    return int(seconds % _state['season_size']) // _state['bucket_size'] % len(_state['season'])
+
+
+def _update(value:float, timestamp:float) -> None:
+    """ feeds the average demand of a finished bucket to the model """
+
+    slot = _slot(timestamp)
+    error = _state['error']
+
+    if _state['forecast'] is not None:
+        diff = value - _state['forecast']
+        weight = max(ERROR_WEIGHT, 1.0 / (error['buckets'] + 1))
+        error['mae'] += weight * (abs(diff) - error['mae'])
+        error['bias'] += weight * (diff - error['bias'])
+        error['buckets'] += 1
+        error['last'] = diff
+        logger.info("forecast {:.1f} jobs, got {:.1f} (mae {:.2f}, bias {:+.2f} over {} buckets)".format(
+            _state['forecast'], value, error['mae'], error['bias'], error['buckets']))
+
+    if _state['level'] is None:
+        _state['level'] = value
+    else:
+        level = _state['level']
+        season = _state['season'][ slot ]
+        _state['level'] = ALPHA * (value - season) + (1 - ALPHA) * (level + _state['trend'])
+        _state['trend'] = BETA * (_state['level'] - level) + (1 - BETA) * _state['trend']
+        # the season is only learned once the level has something to go on
+        _state['season'][ slot ] = GAMMA * (value - _state['level']) + (1 - GAMMA) * season
+
+    if slot == len(_state['season']) - 1:
+        _state['seasons_seen'] += 1
+
+    _state['forecast'] = _predict(1, timestamp)
+
+
+def _predict(buckets:int, timestamp:float) -> float:
+    value = _state['level'] + buckets * _state['trend'] + _state['season'][ _slot(timestamp + buckets * _state['bucket_size']) ]
+    return max(0.0, value)
+
+
+def record(pending:int, running:int, nodes:int, idle:int, timestamp:float=None) -> None:
+    """ records a daemon tick, a finished bucket updates the model
+
+    Args:
+      pending: pending jobs (tasks) nodes can help with
+      running: running jobs
+      nodes: nodes in slurm
+      idle: idle nodes
+    """
+
+    if _state is None:
+        reset()
+
+    if timestamp is None:
+        timestamp = time.time()
+
+    samples.append((timestamp, pending, running, nodes, idle))
+
+    busy = nodes - idle
+    if busy > 0 and running > 0:
+        ratio = running / busy
+        if _state['jobs_per_node'] is None:
+            _state['jobs_per_node'] = ratio
+        else:
+            _state['jobs_per_node'] += ERROR_WEIGHT * (ratio - _state['jobs_per_node'])
+
+    bucket = int(timestamp // _state['bucket_size'])
+    if _state['bucket'] is not None and bucket != _state['bucket'] and _state['count']:
+        _update(_state['sum'] / _state['count'], (_state['bucket'] + 1) * _state['bucket_size'] - 1)
+        _state['sum'] = 0.0
+        _state['count'] = 0
+
+    _state['bucket'] = bucket
+    _state['sum'] += pending + running
+    _state['count'] += 1
+
+
+def record_arrivals(last_job_id:int, timestamp:float=None) -> None:
+    """ follows the job submission rate from the highest job id slurm has handed out
+
+    Jobs that come and go between two ticks are counted as well, as they
+    still used up their job ids.
+    """
+
+    if _state is None:
+        reset()
+
+    if timestamp is None:
+        timestamp = time.time()
+
+    # nothing in the queue to go by
+    if not last_job_id:
+        return
+
+    previous, since = _state['last_job_id'], _state['last_job_time']
+    if previous is not None and last_job_id < previous:
+        # the job ids were reset, start over
+        previous = None
+
+    if previous is not None and timestamp > since:
+        rate = (last_job_id - previous) / (timestamp - since)
+        weight = 1 - math.exp(-(timestamp - since) / ARRIVAL_WINDOW)
+        _state['arrival_rate'] += weight * (rate - _state['arrival_rate'])
+
+    _state['last_job_id'] = last_job_id
+    _state['last_job_time'] = timestamp
+
+
+def arrival_rate() -> float:
+    """ jobs submitted per second, averaged over ARRIVAL_WINDOW """
+
+    if _state is None:
+        return 0.0
+
+    return _state['arrival_rate']
+
+
+def jobs_per_node() -> float:
+    """ running jobs per busy node seen so far, None before any """
+
+    if _state is None:
+        return None
+
+    return _state['jobs_per_node']
+
+
+def forecast(horizon:int, timestamp:float=None) -> float:
+    """ the highest expected job demand from now until horizon seconds ahead, None without history """
+
+    if _state is None or _state['level'] is None:
+        return None
+
+    if timestamp is None:
+        timestamp = time.time()
+
+    buckets = max(1, int(math.ceil(horizon / _state['bucket_size'])))
+    return max([_predict(b, timestamp) for b in range(1, buckets + 1)])
+
+
+def nodes_needed(horizon:int, timestamp:float=None) -> int:
+    """ nodes the forecast demand up to horizon seconds ahead needs, at the jobs per node seen so far """
+
+    demand = forecast(horizon, timestamp)
+    if demand is None or not _state['jobs_per_node']:
+        return 0
+
+    return int(math.ceil(demand / _state['jobs_per_node']))
+
+
+def report() -> dict:
+    """ forecast error and model state, for tuning """
+
+    if _state is None:
+        reset()
+
+    return {'buckets': _state['error']['buckets'],
+            'mae': _state['error']['mae'],
+            'bias': _state['error']['bias'],
+            'last_error': _state['error']['last'],
+            'level': _state['level'],
+            'trend': _state['trend'],
+            'seasons_seen': _state['seasons_seen'],
+            'jobs_per_node': _state['jobs_per_node'],
+            'arrival_rate': _state['arrival_rate'],
+            'next_bucket': _state['forecast']}
@@ -0,0 +1,138 @@
+""" 
+ Ansible inventory helpers, and the inventory cache shared by eccd and ecc_nodes.py
+
+ The daemon writes the current nodes to the cache every tick, so the
+ dynamic inventory script can answer without going to openstack.
+"""
+
+import os
+import sys
+import json
+import time
+import configparser
+
+import kbr.log_utils as logger
+
+
+def inventory_file(ansible_dir:str) -> str:
+    """ the static inventory file used in an ansible dir, taken from ansible.cfg if set there """
+
+    inventory = f"{ansible_dir}/hosts"
+
+    if os.path.isfile(f"{ansible_dir}/ansible.cfg"):
+        config = configparser.ConfigParser()
+        config.read(f"{ansible_dir}/ansible.cfg")
+        if 'defaults' in config and 'inventory' in config['defaults']:
+            inventory = f"{ansible_dir}/{config['defaults']['inventory']}"
+
+    return inventory
+
+
+def readin_inventory(ansible_dir:str) -> {}:
+
+    inventory = inventory_file(ansible_dir)
+
+    try:
+        config = configparser.ConfigParser()
+        config.read(inventory)
+    except:
+        print('could not find or open the inventory file')
+        sys.exit(-1)
+
+
+    hosts = {f"slurm":{"hosts":[]}, "_meta": {"hostvars":{}}}
+
+
+    for section in config.sections():
+        hosts[section] = {}
+        hosts[section]["hosts"] = []
+        for key in config[section].keys():
+            line = f"{key}={''.join(config[section][key])}"
+
+            fields = line.split()
+            host = fields[ 0 ]
+            hosts[section]["hosts"].append( host )
+            hosts["_meta"]['hostvars'][host] = {}
+            for f in fields[1:]:
+                key, value = f.split("=")
+                hosts["_meta"]['hostvars'][host][key] = value
+
+
+    return hosts
+
+
+def _mtime(filename:str) -> float:
+    if not os.path.isfile(filename):
+        return None
+
+    return os.path.getmtime(filename)
+
+
+def inventory_mtimes(ansible_dir:str) -> {}:
+    """ modification times of ansible.cfg and the static inventory, a change in either invalidates the cache """
+
+    return {'ansible.cfg': _mtime(f"{ansible_dir}/ansible.cfg"),
+            'inventory': _mtime(inventory_file(ansible_dir))}
+
+
+def cache_file(ecc_config) -> str:
+    return ecc_config.get('inventory_cache', f"{ecc_config.ansible_dir}/.ecc_inventory.json")
+
+
+def write_cache(filename:str, ansible_dir:str, nodes:[]) -> None:
+    """ writes the static inventory and the cloud nodes to the cache
+
+    Args:
+      filename: cache file
+      ansible_dir: ansible dir holding ansible.cfg and the static inventory
+      nodes: list of dicts with (at least) name and ip
+
+    Returns:
+      None
+    """
+
+    cache = {'timestamp': time.time(),
+             'mtimes': inventory_mtimes(ansible_dir),
+             'inventory': readin_inventory(ansible_dir),
+             'nodes': [{'name': node['name'], 'ip': node['ip']} for node in nodes]}
+
+    try:
+        with open(f"{filename}.tmp", 'w') as outfile:
+            json.dump(cache, outfile)
+            outfile.close()
+
+        os.replace(f"{filename}.tmp", filename)
+    except Exception as e:
+        logger.warning("Could not write inventory cache {}".format(filename))
+        logger.debug("Error: {}".format(e))
+
+
+def read_cache(filename:str, ansible_dir:str, ttl:int=120) -> {}:
+    """ reads the inventory cache if it is still valid
+
+    Args:
+      filename: cache file
+      ansible_dir: ansible dir holding ansible.cfg and the static inventory
+      ttl: max age (s) of the cache
+
+    Returns:
+      dict with inventory and nodes, None if the cache is missing or stale
+    """
+
+    if not os.path.isfile(filename):
+        return None
+
+    try:
+        with open(filename, 'r') as infile:
+            cache = json.load(infile)
+            infile.close()
+    except Exception:
+        return None
+
+    if time.time() - cache.get('timestamp', 0) > ttl:
+        return None
+
+    if cache.get('mtimes', None) != inventory_mtimes(ansible_dir):
+        return None
+
+    return cache
@@ -10,14 +10,42 @@
 import sys
 import os
 import re
+import copy
 import pprint
 
 pp = pprint.PrettyPrinter(indent=4)
 import time
+import threading
 
 import openstack
 import kbr.log_utils as logger
 
+# default time-to-live (s) of the cached openstack resources, a ttl of 0 disables caching
+CACHE_TTL = {'servers': 15,
+             'images': 3600,
+             'flavours': 3600,
+             'resources': 30,
+             'security_groups': 600,
+             'volumes': 60}
+
+# smallest console tail to fetch, and number of lines used to find where the last read stopped
+CONSOLE_TAIL_MIN = 100
+CONSOLE_ANCHOR_LINES = 3
+
+
+def _find_anchor(lines: [], anchor: []) -> int:
+    """ returns the index just after the last occurrence of the anchor lines, None if not found """
+
+    # blank lines are too common to tell where we are
+    if "".join(anchor).strip() == "":
+        return None
+
+    for i in range(len(lines) - len(anchor), -1, -1):
+        if lines[i:i + len(anchor)] == anchor:
+            return i + len(anchor)
+
+    return None
+
 
 class Openstack(object):
 
@@ -38,6 +66,103 @@ class Openstack(object):
         self._backend = "openstack"
         self._connection = None
 
+        self._cache = {}
+        self._cache_ttl = dict(CACHE_TTL)
+        self._cache_stats = {}
+        self._cache_lock = threading.Lock()
+
+        self._console_state = {}
+
+    def set_cache_ttl(self, **ttls):
+        """ sets the time-to-live for one or more cached resources
+
+        Args:
+          ttls: resource=ttl (s) pairs, eg: servers=10, images=3600
+
+        Returns:
+          None
+
+        Raises:
+          RuntimeError if the resource is unknown
+        """
+
+        for resource, ttl in ttls.items():
+            if resource not in CACHE_TTL:
+                raise RuntimeError("Unknown cache resource {}".format(resource))
+
+            self._cache_ttl[resource] = int(ttl)
+
+    def _cache_get(self, resource: str):
+        """ returns a cached resource if it is still fresh
+
+        Args:
+          resource: name of the resource, eg servers
+
+        Returns:
+          copy of the cached value, or None on a miss
+
+        Raises:
+          None
+        """
+
+        with self._cache_lock:
+            stats = self._cache_stats.setdefault(resource, {'hits': 0, 'misses': 0})
+
+            if resource in self._cache:
+                timestamp, value = self._cache[resource]
+                if time.time() - timestamp < self._cache_ttl.get(resource, 0):
+                    stats['hits'] += 1
+                    return copy.deepcopy(value)
+
+            stats['misses'] += 1
+            return None
+
+    def _cache_set(self, resource: str, value):
+        """ stores a copy of a resource in the cache and hands the value back """
+
+        if self._cache_ttl.get(resource, 0) > 0:
+            with self._cache_lock:
+                self._cache[resource] = (time.time(), copy.deepcopy(value))
+
+        return value
+
+    def cache_invalidate(self, *resources):
+        """ drops one or more resources from the cache, all of them if none are given
+
+        Args:
+          resources: names of the resources to drop
+
+        Returns:
+          None
+
+        Raises:
+          None
+        """
+
+        with self._cache_lock:
+            if resources == ():
+                self._cache = {}
+                return
+
+            for resource in resources:
+                self._cache.pop(resource, None)
+
+    def cache_stats(self) -> dict:
+        """ hit/miss counters for the cached resources
+
+        Args:
+          None
+
+        Returns:
+          dict of resource: {'hits': int, 'misses': int}
+
+        Raises:
+          None
+        """
+
+        with self._cache_lock:
+            return copy.deepcopy(self._cache_stats)
+
     def check_connection(self):
         """ Checks that there is a connection to the openstack, otherwise will raise an exception
 
@@ -56,7 +181,7 @@ class Openstack(object):
             raise ConnectionError
 
     def connect(self, auth_url: str, project_name: str, username: str, password: str, region_name: str,
-                user_domain_name: str, project_domain_name: str, **kwargs):
+                user_domain_name: str, project_domain_name: str, cache_ttl: dict = None, **kwargs):
         """ Connects to a openstack cloud
 
         Args:
@@ -65,6 +190,7 @@ class Openstack(object):
           username: name of the user
           password: password for the user
           region_name: global connection
+          cache_ttl: resource=ttl (s) overrides for the resource cache
           **kwargs catches extra cloud information from the config file
         
         Returns:
@@ -84,10 +210,14 @@ class Openstack(object):
             project_domain_name=project_domain_name
         )
 
+        self.cache_invalidate()
+        if cache_ttl is not None:
+            self.set_cache_ttl(**cache_ttl)
+
         logger.debug("Connected to openstack server")
 
     def server_create(self, name: str, image: str, flavor: str, network: str, key: str, security_groups: str,
-                      userdata_file: str = None, **kwargs):
+                      userdata_file: str = None, wait: bool = True, userdata: str = None, **kwargs):
         """ creates and spins up a server
     
         Args:
@@ -97,6 +227,8 @@ class Openstack(object):
           network: type of network to use
           security_groups: External access, ensure the group can connect to other server in the same group
           userdata_file
+          wait: block till the server is active
+          userdata: rendered user-data, used instead of the userdata_file
         
         Returns:
           id (str) of the server
@@ -114,8 +246,8 @@ class Openstack(object):
             raise (RuntimeError("Image {} does not exist in the openstack instance".format(image)))
 
         try:
-            if (userdata_file is not None):
-                user_data_fh = open(userdata_file, 'r')
+            if (userdata is not None or userdata_file is not None):
+                user_data_fh = userdata if userdata is not None else open(userdata_file, 'r')
 
                 server = self._connection.create_server(name,
                                                         image=image,
@@ -124,7 +256,7 @@ class Openstack(object):
                                                         key_name=key,
                                                         security_groups=security_groups,
                                                         userdata=user_data_fh,
-                                                        wait=True,
+                                                        wait=wait,
                                                         auto_ip=True)
             else:
                 server = self._connection.create_server(name,
@@ -133,10 +265,11 @@ class Openstack(object):
                                                         network=network,
                                                         key_name=key,
                                                         security_groups=security_groups,
-                                                        wait=True,
+                                                        wait=wait,
                                                         auto_ip=True)
 
-            logger.debug("Created server id:{} ip:{}".format(server.id, self.server_ip(server.id)))
+            self.cache_invalidate('servers', 'resources')
+            logger.debug("Created server id:{} ip:{}".format(server.id, self._addresses(server)))
 
             return server.id
 
@@ -144,16 +277,38 @@ class Openstack(object):
             print(e)
             raise e
 
-    def servers(self):
+    def servers(self, cache: bool = True):
+        """ lists the servers in the project
+
+        The detailed listing already carries the addresses of each server, so
+        everything is built from the (paginated) list response instead of a
+        get_server call per server.
+
+        Args:
+          cache: use the cached listing if it is still fresh
+
+        Returns:
+          list of dicts (id, name, ip, ip6, status)
+
+        Raises:
+          None
+        """
+
+        servers = self._cache_get('servers') if cache else None
+        if servers is not None:
+            return servers
 
         servers = []
 
-        for server in self._connection.compute.servers():
-            ip = self.server_ip(server.id)
-            servers.append({'id': server.id, 'name': server.name.lower(), 'ip': ip, 'status': server.status.lower()})
+        for server in self._connection.compute.servers(details=True):
+            servers.append({'id': server.id,
+                            'name': server.name.lower(),
+                            'ip': self._addresses(server, ipv=4),
+                            'ip6': self._addresses(server, ipv=6),
+                            'status': server.status.lower()})
 
         logger.debug("Servers: \n{}".format(pp.pformat(servers)))
-        return servers
+        return self._cache_set('servers', servers)
 
 
     def server(self, id:str):
@@ -168,11 +323,12 @@ class Openstack(object):
 
         return names
 
-    def server_delete(self, id: str):
+    def server_delete(self, id: str, check: bool = True):
         """ Deletes a server instance
 
         Args:
           id: name/id of a server
+          check: look the server up before deleting it, skip when the id comes from a fresh listing
 
         Returns:
           None
@@ -182,35 +338,108 @@ class Openstack(object):
         """
 
 
-        if self.server(id) is None:
+        if check and self.server(id) is None:
             logger.debug("Unknown server to delete id:{}".format(id))
             raise RuntimeError("Unknown server {}".format(id))
 
         self._connection.delete_server(id)
+        self._cache_drop_server(id)
         logger.debug("Deleted server id:{}".format(id))
 
-    def server_log(self, id: str):
+    def _cache_drop_server(self, id: str):
+        """ patches a deleted server out of the cached server listing """
+
+        with self._cache_lock:
+            if 'servers' in self._cache:
+                timestamp, servers = self._cache['servers']
+                servers = [server for server in servers if server['id'] != id and server['name'] != id]
+                self._cache['servers'] = (timestamp, servers)
+
+        self.cache_invalidate('resources')
+
+    def server_log(self, id: str, length: int = None):
         """ streams the dmesg? log from a server
         
         Args:
         id: id/name of server
+        length: only fetch the last length lines of the log, default is the whole log
         
         Returns:
-        ?
+        log (str)
         
         Raises:
         None
         """
 
         # needs a check to ensure that something was returned! Will crash!
-        return (self._connection.compute.get_server_console_output(id)['output'])
+        if length is None:
+            return (self._connection.compute.get_server_console_output(id)['output'])
+
+        return (self._connection.compute.get_server_console_output(id, length=length)['output'])
+
+    def server_log_tail(self, id: str) -> []:
+        """ returns the lines added to a server log since the last call
+
+        A per server offset and the last lines seen (the anchor) are kept, the
+        log is fetched as a tail of a few times the previous growth and the
+        new lines are found after the anchor. If the anchor is not in the tail
+        (too many new lines) the full log is fetched instead.
+
+        Args:
+        id: id/name of server
+
+        Returns:
+        list of new log lines
 
-    def server_log_search(self, id: str, match: str):
+        Raises:
+        None
+        """
+
+        state = self._console_state.setdefault(id, {'offset': 0, 'anchor': [], 'length': CONSOLE_TAIL_MIN})
+
+        lines = None
+        if state['offset'] > 0:
+            tail = self.server_log(id, length=state['length']).split("\n")
+            if len(tail) < state['length']:
+                # the whole log fitted in the tail
+                lines = tail
+            else:
+                anchor = _find_anchor(tail, state['anchor'])
+                if anchor is not None:
+                    new_lines = tail[anchor:]
+                    self._console_state_update(state, new_lines, tail)
+                    return new_lines
+
+        if lines is None:
+            lines = self.server_log(id).split("\n")
+
+        new_lines = lines[state['offset']:]
+        self._console_state_update(state, new_lines, lines)
+        return new_lines
+
+    def _console_state_update(self, state: dict, new_lines: [], lines: []):
+        """ moves the offset/anchor of a console tail, and sizes the next tail to the growth seen """
+
+        # the last line can still be written to, so it is read again next time and is not part of the anchor
+        state['offset'] += max(0, len(new_lines) - 1)
+        state['anchor'] = lines[-(CONSOLE_ANCHOR_LINES + 1):-1]
+        state['length'] = max(CONSOLE_TAIL_MIN, 4 * len(new_lines))
+
+    def server_log_reset(self, id: str = None):
+        """ forgets the console offset of a server, or of all servers """
+
+        if id is None:
+            self._console_state = {}
+        else:
+            self._console_state.pop(id, None)
+
+    def server_log_search(self, id: str, match: str, incremental: bool = False):
         """ get a server log and searches for a match 
         
         Args:
           id: id/name of the server 
           match: regex/str of log entry to look for
+          incremental: only search the lines added since the last incremental search
         
         Returns:
           matches found in log, if none found returns an empty list
@@ -219,48 +448,78 @@ class Openstack(object):
           None    
         """
 
-        log = self.server_log(id)
         logger.debug("Spooling server log for id:{}".format(id))
+        if incremental:
+            lines = self.server_log_tail(id)
+        else:
+            lines = self.server_log(id).split("\n")
 
         results = []
-#        logger.debug( log )
 
-        for line in log.split("\n"):
-            if (re.search(match, line)):
+        match = re.compile(match)
+        for line in lines:
+            if (match.search(line)):
                 results.append(line)
 
         return results
 
-    def wait_for_log_entry(self, id: str, match: str = 'The ecc node is up', timeout: int = 400):
-        """ continually checks a server log until a string match is found
+    def wait_for_log_entry(self, id, match: str = 'The ecc node is up', timeout: int = 400,
+                           sleep: float = 1.0, max_sleep: float = 15.0):
+        """ continually checks one or more server logs until a string match is found
+
+        Only the new part of the logs are fetched and searched on each poll, and
+        the time between polls doubles up to max_sleep.
 
         Args:
-        id: id/name of the server 
+        id: id/name of the server, or a list of them
         match: regex/str of log entry to look for
         timeout: max time to check logs for in seconds
+        sleep: initial time between polls in seconds
+        max_sleep: max time between polls in seconds
         
         Returns:
-        matches found in log, if none found returns an empty list
+        matches found in log, for a list of servers a dict of id: matches
 
         Raises:
         TimeoutError if entry not found before timeout is 
         """
 
-        logger.debug("Waiting for log entry  id:{} --> entry:{}".format(id, match))
+        ids = id if isinstance(id, list) else [id]
+        logger.debug("Waiting for log entry  id:{} --> entry:{}".format(ids, match))
 
-        while (True):
-            matches = self.server_log_search(id, match)
+        for server_id in ids:
+            self.server_log_reset(server_id)
 
-            if matches is not None and matches != []:
-                return matches
+        found = {}
+        waiting = list(ids)
+        end_time = time.time() + timeout
 
-            timeout -= 1
-            if (not timeout):
-                raise TimeoutError("Timed out waiting for log entry: {}".format(match))
+        try:
+            while (True):
+                for server_id in list(waiting):
+                    matches = self.server_log_search(server_id, match, incremental=True)
 
-            #        print(". {}".format( timeout))
-            time.sleep(1)
-            logger.debug("sleeping in wait_for_log_entry TO:{}".format(timeout))
+                    if matches is not None and matches != []:
+                        found[server_id] = matches
+                        waiting.remove(server_id)
+
+                if waiting == []:
+                    break
+
+                if time.time() + sleep > end_time:
+                    raise TimeoutError("Timed out waiting for log entry: {} on {}".format(match, ", ".join(waiting)))
+
+                time.sleep(sleep)
+                logger.debug("sleeping in wait_for_log_entry TO:{}".format(int(end_time - time.time())))
+                sleep = min(sleep * 2, max_sleep)
+        finally:
+            for server_id in ids:
+                self.server_log_reset(server_id)
+
+        if isinstance(id, list):
+            return found
+
+        return found[id]
 
     def server_ip(self, id: str, ipv: int = 4):
         """ returns the ip address of a server
@@ -276,10 +535,28 @@ class Openstack(object):
         None
         """
 
-        ips = []
         server = self._connection.compute.get_server(id)
+        return self._addresses(server, ipv=ipv)
+
+    def _addresses(self, server, ipv: int = 4) -> []:
+        """ extracts the ip addresses of a server record
+
+        Args:
+        server: server object, as returned by get_server or a detailed listing
+        ipv: return IP4 or IP6 addresses. IPV4 is default
+
+        Returns:
+        list of IP addresses (str)
+
+        Raises:
+        None
+        """
+
+        ips = []
+
+        if server.addresses is None:
+            return ips
 
-        # print( server.addresses )
         for network in server.addresses:
             for nic in server.addresses[network]:
                 if (nic['version'] == ipv):
@@ -302,12 +579,13 @@ class Openstack(object):
 
         return ips_removed
 
-    def server_stop(self, id: str, timeout: int = 300):
+    def server_stop(self, id: str, timeout: int = 300, wait: bool = True):
         """ stops a server
         
         Args:
         id: the name of the server
         timeout: max time (s) to wait for the server to shotdown
+        wait: wait for the server to be shutoff, otherwise return once the stop is requested
 
         Returns:
         None
@@ -321,6 +599,10 @@ class Openstack(object):
 
         server = self._connection.compute.get_server(id)
         self._connection.compute.stop_server(server)
+        self.cache_invalidate('servers')
+        if not wait:
+            return
+
         while (True):
             server = self._connection.compute.get_server(id)
             if (server.status.lower() == 'shutoff'):
@@ -335,6 +617,54 @@ class Openstack(object):
 
         logger.info("Server stopped id:{} ".format(id))
 
+    def server_start(self, id: str):
+        """ starts a stopped server, the server is active once servers() says so
+
+        Args:
+          id: id of the server
+
+        Returns:
+          None
+        """
+
+        self.check_connection()
+        logger.debug("Starting server id:{}".format(id))
+
+        self._connection.compute.start_server(id)
+        self.cache_invalidate('servers')
+
+    def server_shelve(self, id: str):
+        """ shelves a server, its disk is kept but it no longer takes up a hypervisor
+
+        Args:
+          id: id of the server
+
+        Returns:
+          None
+        """
+
+        self.check_connection()
+        logger.debug("Shelving server id:{}".format(id))
+
+        self._connection.compute.shelve_server(id)
+        self.cache_invalidate('servers', 'resources')
+
+    def server_unshelve(self, id: str):
+        """ brings a shelved server back, the server is active once servers() says so
+
+        Args:
+          id: id of the server
+
+        Returns:
+          None
+        """
+
+        self.check_connection()
+        logger.debug("Unshelving server id:{}".format(id))
+
+        self._connection.compute.unshelve_server(id)
+        self.cache_invalidate('servers', 'resources')
+
     def get_resources(self):
         """ get the resources available for the cloud
 
@@ -348,6 +678,10 @@ class Openstack(object):
           None
         """
 
+        res = self._cache_get('resources')
+        if res is not None:
+            return res
+
         limits = self._connection.compute.get_limits()
         #        pp.pprint( self._connection.block_storage.get_limits())
 
@@ -367,7 +701,7 @@ class Openstack(object):
                'total_ram': total_ram,
                'total_ram_used': total_ram_used}
 
-        return res
+        return self._cache_set('resources', res)
 
     def get_resources_available(self):
         """ get the resources available for the cloud
@@ -402,27 +736,76 @@ class Openstack(object):
           None
         """
 
+        catalogue = self._cache_get('images')
+        if catalogue is None:
+            catalogue = []
+            for image in self._connection.image.images():
+                catalogue.append({'id': image.id,
+                                  'min_disk': image.min_disk,
+                                  'name': image.name,
+                                  'tags': image.tags,
+                                  'min_ram': image.min_ram,
+                                  'status': image.status})
+
+            self._cache_set('images', catalogue)
+
         images = []
-        for image in self._connection.image.images():
-            if active and image.status != "active":
+        for image_info in catalogue:
+            if active and image_info['status'] != "active":
                 continue
 
             if (name is not None and
-                    (name.lower() not in image.name.lower() and
-                     name.lower() not in image.id.lower())):
+                    (name.lower() not in image_info['name'].lower() and
+                     name.lower() not in image_info['id'].lower())):
                 continue
 
-            image_info = {'id': image.id,
-                          'min_disk': image.min_disk,
-                          'name': image.name,
-                          'tags': image.tags,
-                          'min_ram': image.min_ram,
-                          'status': image.status}
-
             images.append(image_info)
 
         return images
 
+    def image_create(self, server_id: str, name: str, wait: bool = True, timeout: int = 3600) -> str:
+        """ snapshots a server into a glance image
+
+        Args:
+          server_id: id of the server, best stopped so the disk is consistent
+          name: name of the image
+          wait: block till the image is active
+          timeout: max time (s) to wait for the image
+
+        Returns:
+          id (str) of the image
+
+        Raises:
+          None
+        """
+
+        self.check_connection()
+        logger.debug("Snapshotting server id:{} into image {}".format(server_id, name))
+
+        image = self._connection.create_image_snapshot(name, server_id, wait=wait, timeout=timeout)
+        self.cache_invalidate('images')
+
+        return image.id
+
+    def image_delete(self, id: str) -> None:
+        """ deletes an image
+
+        Args:
+          id: id of the image
+
+        Returns:
+          None
+
+        Raises:
+          None
+        """
+
+        self.check_connection()
+        logger.debug("Deleting image id:{}".format(id))
+
+        self._connection.delete_image(id)
+        self.cache_invalidate('images')
+
     def get_flavours(self):
         """ get the flavours currently available on the cloud
 
@@ -438,6 +821,10 @@ class Openstack(object):
           None
         """
 
+        flavours = self._cache_get('flavours')
+        if flavours is not None:
+            return flavours
+
         flavours = []
         for flavour in self._connection.compute.flavors():
 
@@ -455,7 +842,7 @@ class Openstack(object):
 
             flavours.append(flavour_info)
 
-        return flavours
+        return self._cache_set('flavours', flavours)
 
     def volume_create(self, size: int, name: str = None, **kwargs) -> str:
         """ Create a volume
@@ -473,6 +860,7 @@ class Openstack(object):
         """
 
         volume = self._connection.create_volume(size=size, name=name)
+        self.cache_invalidate('volumes')
 
         logger.info("Created volume id {} with the size of {}GB".format(volume.id, size))
 
@@ -502,6 +890,7 @@ class Openstack(object):
 
         if (id is not None):
             self._connection.delete_volume(id)
+            self.cache_invalidate('volumes')
             logger.debug("Deleted volume id:{}".format(id))
             if (wait):
                 self._wait_for_volume_deletion(id)
@@ -509,11 +898,12 @@ class Openstack(object):
         else:
             raise RuntimeError("No id or name provided")
 
-    def _volume_exists(self, volume_id: str) -> bool:
+    def _volume_exists(self, volume_id: str, cache: bool = True) -> bool:
         """ Checks if a volume exists or not in the volume list
 
         Args:
           volume_id to look for
+          cache: use the cached volume listing if it is still fresh
 
         Returns:
           True/False if present/not-present
@@ -522,7 +912,7 @@ class Openstack(object):
           None
         """
 
-        for volume in self.volumes():
+        for volume in self.volumes(cache=cache):
             #            print("{} ===== {}".format( volume['id'], volume_id))
             if (volume['id'] == volume_id):
                 return True
@@ -546,7 +936,7 @@ class Openstack(object):
         logger.debug("Waiting for volume {} being deleted".format(id))
 
         while (True):
-            if (self._volume_exists(id) == False):
+            if (self._volume_exists(id, cache=False) == False):
                 logger.debug("Volume {} has been successfully deleted".format(id))
                 return
 
@@ -557,11 +947,11 @@ class Openstack(object):
             if (timeout < 0.0):
                 raise RuntimeError("Volume {} has not been deleted".format(id))
 
-    def volumes(self):
+    def volumes(self, cache: bool = True):
         """ get volumes information, currently one volume can only be attached to one node.
 
         Args:
-          None
+          cache: use the cached listing if it is still fresh
 
         Returns:
           dict of volumes w/ keys (size, attachment, name, id )
@@ -570,6 +960,10 @@ class Openstack(object):
           none
         """
 
+        volumes = self._cache_get('volumes') if cache else None
+        if volumes is not None:
+            return volumes
+
         volumes = []
         for volume in self._connection.block_storage.volumes(details=True):
             #            pp.pprint( volume )
@@ -591,7 +985,7 @@ class Openstack(object):
 
             volumes.append(volume_data)
 
-        return volumes
+        return self._cache_set('volumes', volumes)
 
     def attach_volume(self, server_id: str, volume_id: str):
         """ Attaches a volume to a server
@@ -609,6 +1003,7 @@ class Openstack(object):
         """
 
         attachment = self._connection.compute.create_volume_attachment(server=server_id, volumeId=volume_id)
+        self.cache_invalidate('volumes')
         #        pp.pprint( attachment )
         return attachment.device
 
@@ -745,6 +1140,7 @@ class Openstack(object):
                 raise RuntimeError("Could not find server for attachment:{}".format(attachment_id))
 
         attachment = self._connection.compute.delete_volume_attachment(attachment_id, server=server_id)
+        self.cache_invalidate('volumes')
 
     def detach_volumes_from_server(self, id) -> int:
         """ detaches all volumes attached to a node
@@ -781,6 +1177,10 @@ class Openstack(object):
           None
         """
 
+        res = self._cache_get('security_groups')
+        if res is not None:
+            return res
+
         security_groups = self._connection.network.security_groups()
 
         res = {}
@@ -804,7 +1204,7 @@ class Openstack(object):
 
                 res[security_group.name]['rules'].append(details)
 
-        return res
+        return self._cache_set('security_groups', res)
 
     def security_group_create(self, name: str):
         """ creates a security group for a given connectiona
@@ -825,6 +1225,7 @@ class Openstack(object):
             raise RuntimeError("Openstack security group {} already exist".format(name))
 
         security_group_id = self._connection.network.create_security_group(name=name)
+        self.cache_invalidate('security_groups')
 
         return security_group_id
 
@@ -864,6 +1265,7 @@ class Openstack(object):
                                                             protocol=protocol,
                                                             remote_group_id=remote_group_id,
                                                             remote_ip_prefix=remote_ip_range)
+        self.cache_invalidate('security_groups')
 
     def firewall_add_incoming_rule(self, name: str, port: int, protocol: str, remote_group: str = None,
                                    remote_ip_range: str = None):
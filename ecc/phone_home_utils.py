@@ -0,0 +1,138 @@
+"""
+ Listener for the cloud-init phone_home module, nodes report in when their boot is done
+
+ Every node gets its own secret token (see new_token) in the phone_home
+ url of its user-data, eg:
+
+   phone_home:
+     url: http://10.1.1.10:8088/<token>/$INSTANCE_ID/
+     post: [instance_id, hostname, fqdn]
+     tries: 10
+
+ Only posts to the url of a token that is expected count, the posted
+ instance_id/hostname are just logged, so a host that can reach the port
+ cannot report a node as booted. It can be tried locally with:
+   curl -d 'hostname=ecc1' http://localhost:8088/<token>/
+"""
+
+import time
+import secrets
+import threading
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import kbr.log_utils as logger
+
+
+# a report is at most this big, cloud-init sends a handful of short fields
+MAX_BODY = 64 * 1024
+
+# the tokens of the nodes that are booting, and token: timestamp of the report
+_expected = set()
+_reports = {}
+_lock = threading.Lock()
+_server = None
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        length = min(int(self.headers.get('Content-Length', 0) or 0), MAX_BODY)
+        fields = parse_qs(self.rfile.read(length).decode('utf-8', errors='replace'))
+
+        keys = [key for key in self.path.split("?")[0].split("/") if key != '']
+        claims = []
+        for field in ['instance_id', 'hostname', 'fqdn']:
+            claims.extend(fields.get(field, []))
+
+        if not any([report(key) for key in keys]):
+            logger.warning("phone home from {} without a valid token: {}".format(self.client_address[0], ", ".join(claims)))
+            self.send_response(403)
+            self.end_headers()
+            return
+
+        logger.info("phone home from {}: {}".format(self.client_address[0], ", ".join(claims)))
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.end_headers()
+        self.wfile.write(b"ok\n")
+
+    def log_message(self, format, *args):
+        logger.debug("phone home: " + format % args)
+
+
+def new_token() -> str:
+    """ a new secret for the phone_home url of a node """
+
+    return secrets.token_urlsafe(16)
+
+
+def expect(token:str) -> None:
+    """ accepts reports with this token, an earlier report is kept """
+
+    if token is None:
+        return
+
+    with _lock:
+        _expected.add(token)
+
+
+def report(token:str) -> bool:
+    """ records that the node of a token reported in, False if the token is not expected """
+
+    with _lock:
+        if token not in _expected:
+            return False
+
+        _reports[ token ] = time.time()
+        return True
+
+
+def reported(token:str) -> bool:
+    """ has the node of this token reported in """
+
+    with _lock:
+        return token is not None and token in _reports
+
+
+def forget(token:str) -> None:
+    """ stops accepting reports for a token and drops its report """
+
+    if token is None:
+        return
+
+    with _lock:
+        _expected.discard(token)
+        _reports.pop(token, None)
+
+
+def start(port:int=8088, host:str='127.0.0.1') -> ThreadingHTTPServer:
+    """ starts the listener in a background thread, it is only started once """
+
+    global _server
+
+    if _server is not None:
+        return _server
+
+    _server = ThreadingHTTPServer((host, port), _Handler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name='phone-home', daemon=True).start()
+    logger.info("phone home listener on {}:{}".format(host, port))
+
+    return _server
+
+
+def running() -> bool:
+    return _server is not None
+
+
+def stop() -> None:
+    global _server
+
+    if _server is None:
+        return
+
+    _server.shutdown()
+    _server.server_close()
+    _server = None
@@ -0,0 +1,250 @@
+"""
+ Sizing of scale-outs: how many nodes of which flavour are needed to run the pending jobs
+
+ Pending jobs are grouped by their per node cpu/memory request and packed
+ first-fit-decreasing onto empty nodes, a group at the time, so a queue of
+ thousands of identical jobs costs the same as one.
+"""
+
+import math
+
+import kbr.log_utils as logger
+
+import ecc.slurm_utils as slurm_utils
+
+
+def parse_memory(value:str) -> int:
+    """ squeue memory (eg 500M, 4G, 1T, 2000) in MB, 0 if not set """
+
+    if value is None:
+        return 0
+
+    value = value.strip().upper()
+    if value == '' or value == 'N/A':
+        return 0
+
+    units = {'K': 1.0 / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024}
+    if value[-1] in units:
+        return int(math.ceil(float(value[:-1]) * units[value[-1]]))
+
+    return int(math.ceil(float(value)))
+
+
+def job_requests(jobs:[], array_running:dict=None) -> dict:
+    """ groups pending jobs by their per node request
+
+    Args:
+      jobs: job dicts with id, nodes, cpus and memory (see slurm_utils.SQUEUE_FIELDS)
+      array_running: array job id: running tasks, for throttled arrays
+
+    Returns:
+      dict of (cpus, memory MB) per node: number of nodes worth of requests
+    """
+
+    if array_running is None:
+        array_running = {}
+
+    requests = {}
+    for job in jobs:
+        tasks = slurm_utils.array_task_count(job['id'], array_running.get(slurm_utils.array_id(job['id']), 0))
+        if tasks == 0:
+            continue
+
+        nodes = max(1, int(job.get('nodes', 1) or 1))
+        cpus = int(math.ceil(max(1, int(job.get('cpus', 1) or 1)) / nodes))
+        memory = parse_memory(job.get('memory', '0'))
+
+        requests[ (cpus, memory) ] = requests.get((cpus, memory), 0) + tasks * nodes
+
+    return requests
+
+
+def backlog_core_seconds(jobs:[], runtimes:dict, array_running:dict=None, default_runtime:int=3600) -> int:
+    """ cpu seconds of work in the pending jobs
+
+    Args:
+      jobs: job dicts with id, user, name, cpus and time_limit (see slurm_utils.SQUEUE_FIELDS)
+      runtimes: runtime history, as returned by slurm_utils.job_history
+      array_running: array job id: running tasks, for throttled arrays
+      default_runtime: seconds for jobs without time limit or history
+
+    Returns:
+      core seconds (int)
+    """
+
+    if array_running is None:
+        array_running = {}
+
+    core_seconds = 0
+    for job in jobs:
+        tasks = slurm_utils.array_task_count(job['id'], array_running.get(slurm_utils.array_id(job['id']), 0))
+        if tasks == 0:
+            continue
+
+        cpus = max(1, int(job.get('cpus', 1) or 1))
+        core_seconds += tasks * cpus * slurm_utils.runtime_estimate(job, runtimes, default_runtime)
+
+    return core_seconds
+
+
+def unplaced(requests:dict, free:[]) -> dict:
+    """ the requests left over once the free capacity of the nodes we have is filled, first-fit-decreasing
+
+    Args:
+      requests: (cpus, memory MB): count, as made by job_requests
+      free: free [cpus, memory MB] per node, as returned by slurm_utils.free_capacity
+
+    Returns:
+      (cpus, memory MB): count of the requests that do not fit
+    """
+
+    bins = [list(node) for node in free]
+    left = {}
+
+    for (cpus, memory), count in sorted(requests.items(), reverse=True):
+        for node in bins:
+            if count == 0:
+                break
+
+            fits = min(node[0] // max(1, cpus), node[1] // memory if memory else count, count)
+            node[0] -= fits * cpus
+            node[1] -= fits * memory
+            count -= fits
+
+        if count > 0:
+            left[ (cpus, memory) ] = count
+
+    return left
+
+
+def pack(requests:dict, node_cpus:int, node_memory:int, max_nodes:int=None) -> int:
+    """ number of nodes needed to fit the requests, first-fit-decreasing
+
+    Args:
+      requests: (cpus, memory MB): count, as made by job_requests
+      node_cpus: cpus of a node
+      node_memory: memory (MB) of a node
+      max_nodes: stop packing when this many nodes are needed
+
+    Returns:
+      number of nodes (int)
+    """
+
+    bins = []  # free [cpus, memory] per node
+
+    for (cpus, memory), count in sorted(requests.items(), reverse=True):
+        if cpus > node_cpus or memory > node_memory:
+            logger.debug("{} request(s) for {} cpus/{}MB do not fit a {} cpus/{}MB node".format(count, cpus, memory, node_cpus, node_memory))
+            continue
+
+        # fill up the nodes we already have
+        for free in bins:
+            if count == 0:
+                break
+
+            fits = min(free[0] // cpus, free[1] // memory if memory else count, count)
+            free[0] -= fits * cpus
+            free[1] -= fits * memory
+            count -= fits
+
+        if count == 0:
+            continue
+
+        per_node = min(node_cpus // cpus, node_memory // memory if memory else count)
+        new_nodes = int(math.ceil(count / per_node))
+
+        if max_nodes is not None and len(bins) + new_nodes >= max_nodes:
+            return max_nodes
+
+        for _ in range(0, new_nodes):
+            fits = min(per_node, count)
+            bins.append([node_cpus - fits * cpus, node_memory - fits * memory])
+            count -= fits
+
+    return len(bins)
+
+
+def quota_nodes(resources:dict, node_cpus:int, node_memory:int) -> int:
+    """ number of nodes of a flavour that fit within the available project quota
+
+    Args:
+      resources: as returned by Openstack.get_resources_available (cores, instances, ram)
+    """
+
+    return max(0, min(resources['instances'],
+                      resources['cores'] // max(1, node_cpus),
+                      resources['ram'] // max(1, node_memory)))
+
+
+def tasks_per_node(cpus:int, memory:int, node_cpus:int, node_memory:int) -> int:
+    """ number of requests of cpus/memory a node fits, 0 if none """
+
+    if cpus > node_cpus or memory > node_memory:
+        return 0
+
+    return min(node_cpus // max(1, cpus), node_memory // memory if memory else node_cpus)
+
+
+def assign(requests:dict, pools:dict) -> dict:
+    """ assigns every request group to the pool where a request costs the least
+
+    Args:
+      requests: (cpus, memory MB): count, as made by job_requests
+      pools: pool name: dict with cpus, memory (MB usable by jobs) and cost (per node)
+
+    Returns:
+      dict of pool name: requests
+    """
+
+    assigned = {}
+    for (cpus, memory), count in requests.items():
+        best = None
+        for name, pool in pools.items():
+            per_node = tasks_per_node(cpus, memory, pool['cpus'], pool['memory'])
+            if per_node == 0:
+                continue
+
+            cost = pool['cost'] / per_node
+            if best is None or cost < best[0]:
+                best = (cost, name)
+
+        if best is None:
+            logger.debug("{} request(s) for {} cpus/{}MB do not fit any pool".format(count, cpus, memory))
+            continue
+
+        assigned.setdefault(best[1], {})[ (cpus, memory) ] = count
+
+    return assigned
+
+
+def plan(requests:dict, pools:dict, resources:dict) -> dict:
+    """ number of nodes per pool to run the requests
+
+    Args:
+      requests: (cpus, memory MB): count, as made by job_requests
+      pools: pool name: dict with cpus, ram (MB), memory (MB usable by jobs), cost (per node) and room (nodes)
+      resources: available quota, as returned by Openstack.get_resources_available
+
+    Returns:
+      dict of pool name: number of nodes, pools without nodes are left out
+    """
+
+    resources = dict(resources)
+    nodes = {}
+
+    for name, pool_requests in assign(requests, pools).items():
+        pool = pools[ name ]
+        cap = min(pool['room'], quota_nodes(resources, pool['cpus'], pool['ram']))
+        if cap <= 0:
+            continue
+
+        count = pack(pool_requests, pool['cpus'], pool['memory'], max_nodes=cap)
+        if count == 0:
+            continue
+
+        nodes[ name ] = count
+        resources['instances'] -= count
+        resources['cores'] -= count * pool['cpus']
+        resources['ram'] -= count * pool['ram']
+
+    return nodes
@@ -1,6 +1,10 @@
 import re
+import time
+import shlex
+import subprocess
 
 import kbr.run_utils as run_utils
+import kbr.log_utils as logger
 
 def available() -> bool:
     try:
@@ -15,89 +19,457 @@ def available() -> bool:
 
 
 
-def jobs():
-    #"%.18i %.9P %.8j %.8u %.2t %.10M %.6D %R"
-    #JOBID PARTITION     NAME     USER ST       TIME  NODES NODELIST(REASON)
-    #33187 usegalaxy     test sysadmin  R       0:15      1 slurm.usegalaxy.no
-    cmd = "squeue -hl"
+# squeue/sinfo output fields, '|' separated. The job name can contain anything so it goes last
+SQUEUE_FIELDS = [('id', '%i'),
+                 ('partition', '%P'),
+                 ('user', '%u'),
+                 ('state', '%t'),
+                 ('time', '%M'),
+                 ('nodes', '%D'),
+                 ('cpus', '%C'),
+                 ('memory', '%m'),
+                 ('time_limit', '%l'),
+                 ('reason', '%R'),
+                 ('name', '%j')]
 
-    run = run_utils.launch_cmd( cmd )
+SINFO_FIELDS = [('name', '%N'),
+                ('partition', '%P'),
+                ('avail', '%a'),
+                ('state', '%t')]
 
-#    run = "  33187 usegalaxy     test sysadmin  PD       0:15      1 slurm.usegalaxy.no\n 33187 usegalaxy     test sysadmin  R       0:15      1 slurm.usegalaxy.no"
+# a snapshot is reused by all callers for this many seconds
+SNAPSHOT_MAX_AGE = 5
 
+PENDING_STATES = ['PD', 'PENDING']
 
-    run = run.stdout
-    if run == b'':
-        return []
+# pending reasons more nodes can help with, jobs waiting on eg Dependency or a QOS/association limit cannot be
+SCALABLE_REASONS = ['Resources', 'Priority']
+
+_snapshot = None
+
+# sacct fields of the runtime history, the job name goes last as it may contain a '|'
+HISTORY_FIELDS = ['User', 'ElapsedRaw', 'End', 'JobName']
+
+# a runtime average is over (at most) this many of the latest jobs, so it follows changes
+HISTORY_WINDOW = 50
+
+_history = {'refreshed': 0, 'since': None, 'runtimes': {}}
 
-    run = run.decode('utf-8')
+_start_times = None
+
+
+def _format(fields:[]) -> str:
+    return "|".join([code for _, code in fields])
+
+
+def _parse(output:bytes, fields:[]) -> []:
+    """ parses '|' separated squeue/sinfo output into a list of dicts """
+
+    if output is None or output == b'':
+        return []
 
+    if isinstance(output, bytes):
+        output = output.decode('utf-8')
 
-    jobs = []
-    for line in run.split("\n"):
+    keys = [key for key, _ in fields]
+    entries = []
+    for line in output.split("\n"):
         if line == '':
             continue
-        fields = line.split()
-        jobs.append({"id": fields[0], "user": fields[3], "state":fields[4], "time": fields[5]})
+        values = line.split("|", len(keys) - 1)
+        if len(values) != len(keys):
+            continue
+        entries.append(dict(zip(keys, values)))
 
-    return jobs
+    return entries
 
-def jobs_pending():
-    count = 0
-    for job in jobs():
-        if job['state'] == 'PD' or job['state'] == 'PENDING':
-            count += 1
 
-    return count
+def parse_duration(value:str) -> int:
+    """ slurm time (eg 30, 5:00, 2:00:00, 1-12, 1-00:00:00) in seconds
+
+    A plain number is minutes, as in a time limit. Returns None for UNLIMITED,
+    NOT_SET, INVALID and anything else that is not a time.
+    """
+
+    if value is None:
+        return None
+
+    value = value.strip()
+    days = 0
+    if "-" in value:
+        days, value = value.split("-", 1)
+        try:
+            days = int(days)
+        except ValueError:
+            return None
+
+    try:
+        parts = [int(part) for part in value.split(":")]
+    except ValueError:
+        return None
+
+    if len(parts) == 1:
+        # days-hours, or minutes
+        seconds = parts[0] * 3600 if days else parts[0] * 60
+    elif len(parts) == 2:
+        # days-hours:minutes, or minutes:seconds
+        seconds = parts[0] * 3600 + parts[1] * 60 if days else parts[0] * 60 + parts[1]
+    elif len(parts) == 3:
+        seconds = parts[0] * 3600 + parts[1] * 60 + parts[2]
+    else:
+        return None
+
+    return days * 86400 + seconds
+
+
+def array_task_count(job_id:str, running:int=0) -> int:
+    """ number of runnable tasks in a pending squeue job id, without expanding the array
+
+    A pending array is listed as one line, eg: 1234_[1-500], 1234_[1,3,10-20:2] or
+    1234_[1-500%10]. With a % throttle only throttle - running tasks can start.
+
+    Args:
+      job_id: squeue job id
+      running: tasks of the array already running, only used with a throttle
+
+    Returns:
+      number of tasks (int), 1 for a plain job
+    """
+
+    if "_[" not in job_id or not job_id.endswith("]"):
+        return 1
+
+    expression = job_id[job_id.index("_[") + 2:-1]
+
+    throttle = None
+    if "%" in expression:
+        expression, throttle = expression.split("%", 1)
 
-def jobs_running():
     count = 0
-    for job in jobs():
-        if job['state'] == 'R' or job['state'] == 'RUNNING':
+    for part in expression.split(","):
+        step = 1
+        if ":" in part:
+            part, step = part.split(":", 1)
+            step = max(1, int(step))
+
+        if "-" in part:
+            start, end = part.split("-", 1)
+            if int(end) >= int(start):
+                count += (int(end) - int(start)) // step + 1
+        elif part != '':
             count += 1
 
+    if throttle is not None and throttle != '':
+        count = min(count, max(0, int(throttle) - running))
+
     return count
 
-def job_counts_by_state():
-    counts = {}
-    for job in jobs():
 
-        if job['state'] not in counts:
-            counts[ job['state'] ] = 1
+def job_reason(value:str) -> str:
+    """ the pending reason of a NODELIST(REASON) value, eg: (ReqNodeNotAvail, UnavailableNodes:x) -> ReqNodeNotAvail """
+
+    value = value.strip()
+    if not value.startswith("("):
+        return None
+
+    return value.strip("()").split(",")[0].strip()
+
+
+def job_number(job_id:str) -> int:
+    """ the number a job id (eg 1234, 1234_5, 1234_[1-10], 1234+0) starts with, 0 if none """
+
+    match = re.match(r'\d+', job_id)
+    if match is None:
+        return 0
+
+    return int(match.group(0))
+
+
+def array_id(job_id:str) -> str:
+    """ the array job id of an array task id (1234_7 -> 1234), None for a plain job """
+
+    if "_" not in job_id:
+        return None
+
+    return job_id.split("_", 1)[0]
+
+
+def stream_lines(cmd:str):
+    """ runs a command and yields its stdout line by line (bytes) as it is read from the pipe """
+
+    proc = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=1 << 16)
+    try:
+        for line in proc.stdout:
+            yield line
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+
+def squeue_lines(fields:[]=None):
+    if fields is None:
+        fields = SQUEUE_FIELDS
+
+    return stream_lines(f"squeue -h --format='{_format(fields)}'")
+
+
+def iter_jobs(lines=None, fields:[]=None):
+    """ generator of job dicts, parsed one squeue line at the time
+
+    Args:
+      lines: iterable of '|' separated lines (str/bytes), default is a live squeue
+      fields: the fields of the lines, default SQUEUE_FIELDS
+    """
+
+    if fields is None:
+        fields = SQUEUE_FIELDS
+    if lines is None:
+        lines = squeue_lines(fields)
+
+    keys = [key for key, _ in fields]
+    for line in lines:
+        values = _split(line, len(keys))
+        if values is not None:
+            yield dict(zip(keys, values))
+
+
+def _split(line, nr_fields:int) -> []:
+    if isinstance(line, bytes):
+        line = line.decode('utf-8', errors='replace')
+
+    line = line.rstrip("\n")
+    if line == '':
+        return None
+
+    values = line.split("|", nr_fields - 1)
+    if len(values) != nr_fields:
+        return None
+
+    return values
+
+
+def aggregate_jobs(lines=None, fields:[]=None, keep_states:[]=None) -> dict:
+    """ counts jobs by state and by partition without building a dict per job
+
+    Args:
+      lines: iterable of '|' separated lines (str/bytes), default is a live squeue
+      fields: the fields of the lines, default SQUEUE_FIELDS
+      keep_states: keep the field values (tuples) of jobs in these states
+
+    Returns:
+      dict with jobs_by_state, jobs_by_partition (partition: state: count), kept (list of tuples),
+      array_running (array job id: running/completing tasks) and last_job_id (highest job number)
+    """
+
+    if fields is None:
+        fields = SQUEUE_FIELDS
+    if lines is None:
+        lines = squeue_lines(fields)
+
+    keys = [key for key, _ in fields]
+    state_index = keys.index('state')
+    partition_index = keys.index('partition')
+
+    id_index = keys.index('id')
+
+    by_state = {}
+    by_partition = {}
+    kept = []
+    array_running = {}
+    last_job_id = 0
+    for line in lines:
+        values = _split(line, len(keys))
+        if values is None:
+            continue
+
+        job_id = job_number(values[ id_index ])
+        if job_id > last_job_id:
+            last_job_id = job_id
+
+        state = values[ state_index ]
+        by_state[ state ] = by_state.get(state, 0) + 1
+        partition = by_partition.setdefault(values[ partition_index ], {})
+        partition[ state ] = partition.get(state, 0) + 1
+
+        if keep_states is not None and state in keep_states:
+            kept.append(tuple(values))
+        elif state in ['R', 'CG', 'RUNNING', 'COMPLETING']:
+            array = array_id(values[ id_index ])
+            if array is not None:
+                array_running[ array ] = array_running.get(array, 0) + 1
+
+    return {'jobs_by_state': by_state, 'jobs_by_partition': by_partition, 'kept': kept, 'array_running': array_running,
+            'last_job_id': last_job_id}
+
+
+def _count(entries:[], key:str, by:str=None) -> dict:
+    counts = {}
+    for entry in entries:
+        if by is None:
+            counts[ entry[key] ] = counts.get(entry[key], 0) + 1
         else:
-            counts[ job['state'] ] += 1
+            group = counts.setdefault(entry[by], {})
+            group[ entry[key] ] = group.get(entry[key], 0) + 1
 
     return counts
 
 
+def _group_nodes(entries:[]) -> []:
+    """ one entry per node, sinfo -N lists a node once for every partition it is in
 
-def nodes():
-    #PARTITION             AVAIL  TIMELIMIT  NODES  STATE NODELIST
-    #usegalaxy_production*    up   infinite      2    mix nrec1.usegalaxy.no,slurm.usegalaxy.no
-    #usegalaxy_production*    up   infinite      1   idle nrec2.usegalaxy.no
+    The partitions of a node are collected in 'partitions', 'partition' is the first one.
+    """
+
+    grouped = {}
+    for entry in entries:
+        if entry['name'] in grouped:
+            grouped[ entry['name'] ]['partitions'].append(entry['partition'])
+        else:
+            grouped[ entry['name'] ] = dict(entry, partitions=[entry['partition']])
+
+    return list(grouped.values())
+
+
+def snapshot(refresh:bool=False) -> dict:
+    """ the jobs and nodes of the cluster from one squeue and one sinfo call
+
+    The snapshot is shared by the job/node functions below, it is taken
+    again when it is older than SNAPSHOT_MAX_AGE or when refresh is set.
+
+    squeue is read as a stream and only pending jobs are kept, as field
+    tuples, so large queues do not build a dict per job.
+
+    Returns:
+      dict with pending (tuples, see SQUEUE_FIELDS), tasks_pending (array tasks counted),
+      pending_by_reason (reason: tasks), array_running, last_job_id, nodes (one per node), jobs_by_state,
+      jobs_by_partition (partition: state: count), nodes_by_state, nodes_by_partition and timestamp
+    """
+
+    global _snapshot
+
+    if not refresh and _snapshot is not None and time.time() - _snapshot['timestamp'] < SNAPSHOT_MAX_AGE:
+        return _snapshot
+
+    #JOBID|PARTITION|USER|ST|TIME|NODES|CPUS|MIN_MEMORY|TIME_LIMIT|NODELIST(REASON)|NAME
+    #33187|usegalaxy|sysadmin|R|0:15|1|2|4G|1-00:00:00|slurm.usegalaxy.no|test
+    jobs = aggregate_jobs(keep_states=PENDING_STATES)
+
+    keys = [key for key, _ in SQUEUE_FIELDS]
+    id_index = keys.index('id')
+    reason_index = keys.index('reason')
+    tasks_pending = 0
+    pending_by_reason = {}
+    for values in jobs['kept']:
+        job_id = values[ id_index ]
+        tasks = array_task_count(job_id, jobs['array_running'].get(array_id(job_id), 0))
+        tasks_pending += tasks
+        reason = job_reason(values[ reason_index ])
+        pending_by_reason[ reason ] = pending_by_reason.get(reason, 0) + tasks
+
+    #NODELIST|PARTITION|AVAIL|STATE
+    #nrec1.usegalaxy.no|usegalaxy_production*|up|mix
     #State of the nodes.  Possible states include: allocated, completing, down, drained, draining, fail, failing, future, idle, maint, mixed, perfctrs, power_down, power_up, reserved, and unknown plus Their abbreviated forms: alloc, comp, down, drain, drng, fail, failg, futr, idle, maint, mix, npc,  pow_dn,  pow_up,
     #               resv, and unk respectively.  Note that the suffix "*" identifies nodes that are presently not responding.
-    cmd = "sinfo -h"
+    run = run_utils.launch_cmd( f"sinfo -h -N --format='{_format(SINFO_FIELDS)}'" )
+    node_partitions = _parse(run.stdout, SINFO_FIELDS)
+    nodes = _group_nodes(node_partitions)
 
-    run = run_utils.launch_cmd( cmd )
+    _snapshot = {'timestamp': time.time(),
+                 'pending': jobs['kept'],
+                 'tasks_pending': tasks_pending,
+                 'pending_by_reason': pending_by_reason,
+                 'array_running': jobs['array_running'],
+                 'last_job_id': jobs['last_job_id'],
+                 'nodes': nodes,
+                 'jobs_by_state': jobs['jobs_by_state'],
+                 'jobs_by_partition': jobs['jobs_by_partition'],
+                 'nodes_by_state': _count(nodes, 'state'),
+                 'nodes_by_partition': _count(node_partitions, 'state', by='partition')}
 
-#    run = " usegalaxy_production*    up   infinite      2    mix nrec1.usegalaxy.no,slurm.usegalaxy.no\n  usegalaxy_production*    up   infinite      1   alloc nrec2.usegalaxy.no"
+    return _snapshot
 
-    run = run.stdout
-    if run == b'':
-        return []
 
-    run = run.decode('utf-8')
+def parse_start_time(value:str) -> float:
+    """ squeue start time (eg 2021-03-01T12:00:00) as epoch, None if N/A or not a time """
 
-    nodes = []
-    for line in run.split("\n"):
-        if line == '':
+    try:
+        return time.mktime(time.strptime(value.strip(), "%Y-%m-%dT%H:%M:%S"))
+    except ValueError:
+        return None
+
+
+def start_times(refresh:bool=False) -> dict:
+    """ expected start times of the pending jobs, from `squeue --start`
+
+    The estimates come from the backfill scheduler, jobs it has not planned
+    yet have None. Shares the snapshot max age.
+
+    Returns:
+      dict of job id: epoch or None
+    """
+
+    global _start_times
+
+    if not refresh and _start_times is not None and time.time() - _start_times[0] < SNAPSHOT_MAX_AGE:
+        return _start_times[1]
+
+    fields = [('id', '%i'), ('start', '%S')]
+    starts = {}
+    for job in iter_jobs(stream_lines(f"squeue -h --start -t PD --format='{_format(fields)}'"), fields):
+        starts[ job['id'] ] = parse_start_time(job['start'])
+
+    _start_times = (time.time(), starts)
+    return starts
+
+
+def jobs():
+    return list(iter_jobs())
+
+
+def pending_jobs(reasons:[]=None):
+    """ the pending jobs of the snapshot as dicts, generated one at the time
+
+    Args:
+      reasons: only jobs pending for one of these reasons, default all
+    """
+
+    keys = [key for key, _ in SQUEUE_FIELDS]
+    reason_index = keys.index('reason')
+    for values in snapshot()['pending']:
+        if reasons is not None and job_reason(values[ reason_index ]) not in reasons:
             continue
-        fields = line.split()
-        for node in fields[5].split(","):
-            nodes.append( {'name':node, 'avail': fields[2], "state": fields[4]})
+        yield dict(zip(keys, values))
+
+
+def jobs_pending(reasons:[]=None):
+    """ pending demand, a pending job array counts as its number of runnable tasks
+
+    Args:
+      reasons: only count jobs pending for one of these reasons, eg SCALABLE_REASONS, default all
+    """
+
+    if reasons is None:
+        return snapshot()['tasks_pending']
+
+    counts = snapshot()['pending_by_reason']
+    return sum([counts.get(reason, 0) for reason in reasons])
+
+
+def pending_counts_by_reason():
+    return dict(snapshot()['pending_by_reason'])
+
+
+def jobs_running():
+    counts = snapshot()['jobs_by_state']
+    return counts.get('R', 0) + counts.get('RUNNING', 0)
+
+
+def job_counts_by_state():
+    return dict(snapshot()['jobs_by_state'])
+
 
-    return nodes
+def nodes():
+    return snapshot()['nodes']
 
 
 def node_names() -> []:
@@ -109,67 +481,222 @@ def node_names() -> []:
 
 
 def nodes_idle():
-    count = 0
-    for node in nodes():
-        if node['state'] in ['mix', 'idle']:
-            count += 1
-
-    return count
+    counts = snapshot()['nodes_by_state']
+    return counts.get('mix', 0) + counts.get('idle', 0)
 
 
 def nodes_total():
-    count = 0
-    for _ in nodes():
-        count += 1
+    return len(nodes())
 
-    return count
 
+def history_key(name:str) -> str:
+    """ job name with the numbers left out, galaxy names its jobs g<job id>_<tool>_<user> """
 
-def _show_node(id:str) -> str:
-    cmd = 'scontrol show node={id}'
-    run = run_utils.launch_cmd( cmd )
-    return run.stdout
+    return re.sub(r'\d+', '#', name or '')
 
-def node_state(id:str) -> str:
-    info = _show_node(id)
-    for line in info.split('\n'):
-        State=IDLE
-        state = re.match(r'State=(w+)', line)
-        print(state)
-        if state:
-            return state
 
-    return None
+def update_history(lines, runtimes:dict, since:str=None) -> str:
+    """ adds completed jobs to the runtime table
 
+    The table has an entry per user and job name, and one per job name for
+    any user: "user|name": [jobs, mean runtime]. The mean is a running mean
+    over the last HISTORY_WINDOW jobs.
 
-def node_cpu_info(id:str) -> dict:
+    Args:
+      lines: '|' separated sacct lines (str/bytes), see HISTORY_FIELDS
+      runtimes: the table to update
+      since: skip jobs that ended at or before this (sacct timestamp)
 
-    info = _show_node(id)
-    for line in info.split('\n'):
-        cpus = re.match(r'CPUAlloc=(\d+) CPUTot=(\d+) CPULoad=(\d+.\d\d)', line)
-        print(cpus)
-        if cpus:
-            return cpus
+    Returns:
+      the latest end time seen, or since
+    """
 
+    latest = since
+    for line in lines:
+        values = _split(line, len(HISTORY_FIELDS))
+        if values is None:
+            continue
+
+        user, elapsed, end, name = values
+        if not elapsed.isdigit() or end in ['', 'Unknown']:
+            continue
+        if since is not None and end <= since:
+            continue
 
-    return None
+        if latest is None or end > latest:
+            latest = end
 
+        name = history_key(name)
+        for key in [f"{user}|{name}", f"|{name}"]:
+            entry = runtimes.setdefault(key, [0, 0.0])
+            entry[0] += 1
+            entry[1] += (int(elapsed) - entry[1]) / min(entry[0], HISTORY_WINDOW)
 
+    return latest
 
-def free_resources():
-    nodes = nodes()
 
+def job_history(refresh:int=300, days:int=7) -> dict:
+    """ runtime table of completed jobs, see update_history
+
+    The first call reads the last days of sacct, later calls (at most every
+    refresh seconds) only read the jobs that ended since the previous one.
+    An empty table is returned when job accounting is not available.
+    """
+
+    if _history['since'] is not None and time.time() - _history['refreshed'] < refresh:
+        return _history['runtimes']
+
+    since = _history['since']
+    if since is None:
+        since = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(time.time() - days * 86400))
+
+    fields = ",".join(HISTORY_FIELDS)
+    try:
+        lines = stream_lines(f"sacct -a -X -n -P --state=CD -S {since} -E now --format={fields}")
+        _history['since'] = update_history(lines, _history['runtimes'], _history['since']) or since
+    except OSError as e:
+        logger.debug(f"no job history: {e}")
+        _history['since'] = since
+
+    _history['refreshed'] = time.time()
+    return _history['runtimes']
+
+
+def runtime_estimate(job:dict, runtimes:dict, default:int=3600) -> int:
+    """ expected runtime (seconds) of a job
+
+    The mean runtime of earlier jobs with the same name by the same user, or
+    by anyone, capped by the time limit of the job. Without history the
+    time limit, and without that the default.
+    """
+
+    limit = parse_duration(job.get('time_limit', None))
+    name = history_key(job.get('name', None))
+
+    history = runtimes.get(f"{job.get('user', '')}|{name}", None) or runtimes.get(f"|{name}", None)
+    if history is not None:
+        return int(history[1]) if limit is None else min(int(history[1]), limit)
+
+    if limit is not None:
+        return limit
+
+    return default
+
+
+# scontrol show node -o keys we keep, and what they are called in the resource table
+NODE_RESOURCE_KEYS = {'CPUAlloc': 'cpu_alloc',
+                      'CPUTot': 'cpu_total',
+                      'CPULoad': 'cpu_load',
+                      'RealMemory': 'memory',
+                      'AllocMem': 'memory_alloc',
+                      'State': 'state',
+                      'Partitions': 'partitions'}
+
+_node_resource_regex = re.compile(r'(?:^|\s)(NodeName|{})=(\S*)'.format("|".join(NODE_RESOURCE_KEYS.keys())))
+
+_node_resources = None
+
+
+def _to_number(value:str, cast=int):
+    try:
+        return cast(value)
+    except ValueError:
+        return 0
+
+
+def parse_node_resources(output) -> dict:
+    """ parses `scontrol show node -o` output, one line per node
+
+    Returns:
+      dict of node name: {cpu_alloc, cpu_total, cpu_load, memory, memory_alloc, state, partitions}
+    """
+
+    if isinstance(output, bytes):
+        output = output.decode('utf-8')
+
+    table = {}
+    for line in output.split("\n"):
+        name = None
+        node = {'cpu_alloc': 0, 'cpu_total': 0, 'cpu_load': 0.0, 'memory': 0, 'memory_alloc': 0, 'state': None, 'partitions': None}
+        for key, value in _node_resource_regex.findall(line):
+            if key == 'NodeName':
+                name = value
+            elif key == 'CPULoad':
+                node['cpu_load'] = _to_number(value, float)
+            elif key in ['State', 'Partitions']:
+                node[ NODE_RESOURCE_KEYS[key] ] = value
+            else:
+                node[ NODE_RESOURCE_KEYS[key] ] = _to_number(value)
+
+        if name is not None:
+            table[ name ] = node
+
+    return table
+
+
+def node_resources(refresh:bool=False) -> dict:
+    """ cpu/memory allocation of all nodes from a single `scontrol show node -o` call
+
+    Shares the snapshot max age, see parse_node_resources for the format
+    """
+
+    global _node_resources
+
+    if not refresh and _node_resources is not None and time.time() - _node_resources[0] < SNAPSHOT_MAX_AGE:
+        return _node_resources[1]
+
+    run = run_utils.launch_cmd( "scontrol show node -o" )
+    _node_resources = (time.time(), parse_node_resources(run.stdout))
+
+    return _node_resources[1]
+
+
+def node_state(id:str) -> str:
+    node = node_resources().get(id, None)
+    if node is None:
+        return None
+
+    return node['state']
+
+
+def node_cpu_info(id:str) -> dict:
+    return node_resources().get(id, None)
+
+
+def free_resources():
     cpus_total = 0
     cpus_free  = 0
 
-    for node in nodes:
-        cpu_free, cpu_total  = node_cpu_info( node['id'])
+    for node in node_resources().values():
+        cpus_free  += node['cpu_total'] - node['cpu_alloc']
+        cpus_total += node['cpu_total']
 
-        cpus_free  += cpu_free
-        cpus_total += cpu_total
+    return cpus_free, cpus_total
 
 
-    return cpus_free, cpus_total
+def free_memory():
+    memory_total = 0
+    memory_free  = 0
+
+    for node in node_resources().values():
+        memory_free  += node['memory'] - node['memory_alloc']
+        memory_total += node['memory']
+
+    return memory_free, memory_total
+
+
+def free_capacity() -> []:
+    """ free [cpus, memory MB] of every node slurm can schedule on, see node_resources """
+
+    free = []
+    for node in node_resources().values():
+        state = (node['state'] or '').split('+')
+        if state[0] not in ['IDLE', 'MIXED'] or any(flag in state for flag in ['DRAIN', 'MAINT', 'RESERVED', 'NOT_RESPONDING']):
+            continue
+
+        free.append([node['cpu_total'] - node['cpu_alloc'], node['memory'] - node['memory_alloc']])
+
+    return free
 
 
 def add_cloud_node(name, ip_address):
@@ -184,8 +711,11 @@ def update_node_state(name, state:str='idle'):
 def set_node_down(name:str):
     update_node_state(name, 'down')
 
-def set_node_drain(name:str):
-    update_node_state(name, 'draining')
+def set_node_drain(name:str, reason:str='ecc'):
+    """ drains a node, slurm wants a reason for it. The running jobs finish, no new ones start """
+
+    cmd = f"scontrol update nodename={name} state=drain reason={shlex.quote(reason)}"
+    run = run_utils.launch_cmd( cmd )
 
 def set_node_resume(name:str):
     update_node_state(name, 'resume')